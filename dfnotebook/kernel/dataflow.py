@@ -1,7 +1,17 @@
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
 from collections.abc import KeysView, ItemsView, ValuesView, MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from .dflink import LinkedResult
+from .spill import DataflowSpillStore
+import hashlib
+import heapq
+import io
 import itertools
+import pickle
+import sys
+import time
+import tokenize
+import types
 
 class DataflowCellException(Exception):
     def __init__(self, cid):
@@ -19,16 +29,134 @@ class DataflowInvalidRefError(DataflowCellException):
     def __str__(self):
         return "Invalid Reference to Cell '{}'".format(self.cid)
 
+def value_size(value, depth=2):
+    '''Estimate the memory held by a cell result in bytes'''
+    if isinstance(value, LinkedResult):
+        return sum(value_size(v, depth) for v in value.values())
+    memory_usage = getattr(value, 'memory_usage', None)
+    if callable(memory_usage) and hasattr(value, 'columns'):
+        # pandas; deep=True is too slow for large object columns
+        try:
+            return int(memory_usage(index=True).sum())
+        except Exception:
+            pass
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    size = sys.getsizeof(value, 0)
+    if depth > 0:
+        if isinstance(value, dict):
+            size += sum(value_size(k, depth - 1) + value_size(v, depth - 1)
+                        for k, v in value.items())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            size += sum(value_size(v, depth - 1) for v in value)
+    return size
+
+_IGNORED_TOKENS = {tokenize.COMMENT, tokenize.NL, tokenize.ENDMARKER}
+_LAYOUT_TOKENS = {tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT}
+
+def code_fingerprint(code):
+    '''Hash cell code, ignoring comments and whitespace'''
+    try:
+        data = repr([(tok.type, '' if tok.type in _LAYOUT_TOKENS else tok.string)
+                     for tok in tokenize.generate_tokens(io.StringIO(code).readline)
+                     if tok.type not in _IGNORED_TOKENS])
+    except (tokenize.TokenError, SyntaxError):
+        data = code
+    return hashlib.sha1(data.encode()).hexdigest()
+
+def value_fingerprint(value):
+    '''Hash the pickled contents of a cell result, None if it cannot be pickled'''
+    h = hashlib.blake2b(digest_size=16)
+
+    def update(v):
+        if isinstance(v, types.ModuleType):
+            h.update(b'module:' + v.__name__.encode())
+            return
+        buffers = []
+        h.update(pickle.dumps(v, protocol=5, buffer_callback=buffers.append))
+        for buf in buffers:
+            h.update(buf.raw())
+
+    try:
+        if isinstance(value, LinkedResult):
+            for key, v in value.items():
+                h.update(repr(key).encode())
+                update(v)
+        else:
+            update(value)
+    except Exception:
+        return None
+    return h.hexdigest()
+
+class DataflowReachabilityIndex(object):
+    '''Transitive closure of the dependency graph
+
+    Closures are computed on first use and then maintained as edges are
+    added; removing an edge only drops the cached closures it can shrink.
+    '''
+    def __init__(self, parents, children):
+        self.parents = parents
+        self.children = children
+        self.upstream = {}
+        self.downstream = {}
+
+    @staticmethod
+    def closure(k, edges):
+        res = set()
+        frontier = deque(edges[k]) if k in edges else deque()
+        while frontier:
+            cid = frontier.popleft()
+            if cid in res:
+                continue
+            res.add(cid)
+            if cid in edges:
+                frontier.extend(edges[cid])
+        return res
+
+    def get_upstream(self, k):
+        if k not in self.upstream:
+            self.upstream[k] = self.closure(k, self.parents)
+        return self.upstream[k]
+
+    def get_downstream(self, k):
+        if k not in self.downstream:
+            self.downstream[k] = self.closure(k, self.children)
+        return self.downstream[k]
+
+    def add_edge(self, parent, child):
+        # called after the edge is in the graph; every new path
+        # goes through parent -> child
+        ups = self.get_upstream(parent) | {parent}
+        downs = self.get_downstream(child) | {child}
+        for cid in downs:
+            if cid in self.upstream:
+                self.upstream[cid] |= ups
+        for pid in ups:
+            if pid in self.downstream:
+                self.downstream[pid] |= downs
+
+    def remove_edge(self, parent, child):
+        # called before the edge leaves the graph
+        for cid in self.get_downstream(child) | {child}:
+            self.upstream.pop(cid, None)
+        for pid in self.get_upstream(parent) | {parent}:
+            self.downstream.pop(pid, None)
+
 class DataflowHistoryManager(object):
-    deleted_cells = []
-    storeditems = []
     tup_flag = False
 
     def __init__(self, shell, **kwargs):
         self.shell = shell
         self.flags = dict(kwargs)
+        self.deleted_cells = []
+        # one journal of added edges per running execution, innermost last
+        self.journals = []
+        # references already resolved by each running execution
+        self.ref_memos = []
         self.auto_update_flags = {}
         self.force_cached_flags = {}
+        self._spill_store = None
         # self.flags['silent'] = True
         self.clear()
 
@@ -36,12 +164,39 @@ class DataflowHistoryManager(object):
         self.flags.update(kwargs)
         # self.flags['silent'] = True
 
-    def update_code(self, key, code):        
+    @property
+    def cache_limit(self):
+        return getattr(self.shell, 'value_cache_limit', 0)
+
+    @property
+    def memoize(self):
+        return getattr(self.shell, 'memoize_results', False)
+
+    @property
+    def spill_store(self):
+        spill_dir = getattr(self.shell, 'value_cache_spill_dir', '')
+        if spill_dir and self._spill_store is None:
+            self._spill_store = DataflowSpillStore(spill_dir)
+        return self._spill_store
+
+    def code_changed(self, key, code):
+        return ((code == '' and key in self.last_calculated) or
+                key not in self.code_cache or self.code_cache[key] != code)
+
+    def update_code(self, key, code, mark_stale=True):
         # print("CALLING UPDATE CODE", key, code)
         # if code is empty, remove the code_cache, remove links
-        if code == '' and key in self.value_cache:
-            self.set_stale(key)
-            del self.value_cache[key]
+        if code == '' and key in self.last_calculated:
+            if mark_stale:
+                self.set_stale(key)
+            # may have been evicted already
+            self.value_cache.pop(key, None)
+            self.value_sizes.pop(key, None)
+            self.compute_times.pop(key, None)
+            self.value_fingerprints.pop(key, None)
+            self.memo_keys.pop(key, None)
+            if self._spill_store is not None:
+                self._spill_store.discard(key)
             del self.code_cache[key]
             for child in self.all_downstream(key):
                 self.remove_dependencies(key, child)
@@ -57,19 +212,29 @@ class DataflowHistoryManager(object):
             self.shell.dataflow_state.reset_cell(key)
             self.func_cached[key] = False
             self.code_cache[key] = code
-            self.set_stale(key)
+            if mark_stale:
+                self.set_stale(key)
             if key not in self.auto_update_flags:
                 self.auto_update_flags[key] = False;
             if key not in self.force_cached_flags:
                 self.force_cached_flags[key] = False;
 
-    def update_codes(self, code_dict):
+    def update_codes(self, code_dict, cell_ids=None):
+        # a partial code_dict only holds changed cells, with the cells
+        # that still exist listed in cell_ids
         existing_keys = set(self.code_cache.keys())
-        deleted_keys = existing_keys.difference(code_dict.keys())
-        for key, val in code_dict.items():
-            self.update_code(key, val)
-        for key in deleted_keys:
-            self.update_code(key, '')
+        deleted_keys = existing_keys.difference(code_dict.keys() if cell_ids is None
+                                                else cell_ids)
+        changed = {key: val for key, val in code_dict.items()
+                   if self.code_changed(key, val)}
+        changed.update((key, '') for key in deleted_keys
+                       if self.code_changed(key, ''))
+        # invalidate everything downstream of the changes at once, before
+        # deleted cells drop their edges
+        self.invalidated_count = self.set_stale_all(changed.keys())
+        for key, val in changed.items():
+            self.update_code(key, val, mark_stale=False)
+        return self.invalidated_count
 
     def update_auto_update(self, flags):
         self.auto_update_flags.update(flags)
@@ -83,17 +248,83 @@ class DataflowHistoryManager(object):
         for cid in self.all_downstream(key):
             self.code_stale[cid] = True
 
+    def set_stale_all(self, keys):
+        stale = set(keys)
+        frontier = deque(stale)
+        while frontier:
+            cid = frontier.popleft()
+            for child in self.dep_children.get(cid, ()):
+                if child not in stale:
+                    stale.add(child)
+                    frontier.append(child)
+        for cid in stale:
+            self.code_stale[cid] = True
+        return len(stale)
+
     def set_not_stale(self, key):
         self.code_stale[key] = False
 
     def is_stale(self, key):
         return key in self.code_stale and self.code_stale[key]
 
-    def update_value(self, key, value):
+    def update_value(self, key, value, compute_time=None):
 
         self.value_cache[key] = value
         self.last_calculated[key] = self.last_calculated_ctr
         self.last_calculated_ctr += 1
+        if compute_time is not None:
+            self.compute_times[key] = compute_time
+        self.value_sizes.pop(key, None)
+        self.value_fingerprints.pop(key, None)
+        if self.memoize:
+            self.memo_keys[key] = self.memo_key(key)
+        if self._spill_store is not None:
+            self._spill_store.discard(key)
+        if self.cache_limit:
+            self.cull_cache(keep=key)
+
+    def cull_cache(self, keep=None):
+        '''Evict cached results until the cache fits in cache_limit
+
+        Results that are cheapest to recompute per byte go first. Evicted
+        cells stay computed (in last_calculated) and are recomputed the
+        next time they are referenced; force cached cells are never evicted.
+        With a spill directory, the least recently calculated results are
+        written to disk instead and loaded back when referenced.
+        '''
+        limit = self.cache_limit
+        if not limit:
+            return []
+        for k, value in self.value_cache.items():
+            if k not in self.value_sizes:
+                self.value_sizes[k] = value_size(value)
+        total = sum(self.value_sizes[k] for k in self.value_cache)
+        if total <= limit:
+            return []
+        candidates = [k for k in self.value_cache
+                      if k != keep and k in self.code_cache and
+                      not self.force_cached_flags.get(k)]
+        store = self.spill_store
+        if store is not None:
+            candidates.sort(key=lambda k: self.last_calculated[k])
+        else:
+            candidates.sort(key=lambda k: (self.compute_times.get(k, 0.0) /
+                                           max(self.value_sizes[k], 1),
+                                           self.last_calculated[k]))
+        evicted = []
+        for k in candidates:
+            if total <= limit:
+                break
+            if store is not None and k not in store:
+                try:
+                    store.store(k, self.value_cache[k])
+                except Exception:
+                    # unpicklable results are dropped and recomputed
+                    store.discard(k)
+            total -= self.value_sizes.pop(k)
+            del self.value_cache[k]
+            evicted.append(k)
+        return evicted
 
     def sorted_keys(self):
         return (k2 for (v2, k2) in sorted((v, k) for (k, v) in self.last_calculated.items()))
@@ -103,17 +334,118 @@ class DataflowHistoryManager(object):
         self.code_cache = {}
         self.code_stale = {}
         self.value_cache = {}
+        self.value_sizes = {}
+        self.compute_times = {}
+        self.value_fingerprints = {}
+        self.memo_keys = {}
         self.last_calculated = {}
+        self.invalidated_count = 0
         # dependencies are a DAG
         self.dep_parents = defaultdict(set) # child -> list(parent)
         self.dep_children = defaultdict(set) # parent -> list(child)
         self.dep_semantic_parents = defaultdict(dict)
+        self.dep_index = DataflowReachabilityIndex(self.dep_parents,
+                                                   self.dep_children)
         self.last_calculated_ctr = 0
+        # cells that failed while running ahead of the current request
+        self.failed_cells = set()
+        self.auto_update_cascade = set()
+        if self._spill_store is not None:
+            self._spill_store.clear()
+
+    def restore_value(self, k, future=None):
+        '''Load a spilled result back into the value cache'''
+        try:
+            value = (future.result() if future is not None
+                     else self._spill_store.load(k))
+        except Exception:
+            self._spill_store.discard(k)
+            return False
+        if isinstance(value, LinkedResult):
+            value.__sethist__(self)
+        self.value_cache[k] = value
+        # mapped buffers are paged in by the OS, only count the rest
+        self.value_sizes[k] = self._spill_store.resident_size(k)
+        return True
+
+    def restore_values(self, keys):
+        '''Load spilled results, reading several files at once if allowed'''
+        store = self._spill_store
+        if store is None:
+            return
+        keys = [k for k in keys if k not in self.value_cache and k in store]
+        workers = min(getattr(self.shell, 'spill_load_workers', 0), len(keys))
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as pool:
+                futures = [(k, pool.submit(store.load, k)) for k in keys]
+            for k, future in futures:
+                self.restore_value(k, future)
+        else:
+            for k in keys:
+                self.restore_value(k)
+
+    def get_fingerprint(self, k):
+        if k not in self.value_fingerprints:
+            if k not in self.value_cache:
+                return None
+            self.value_fingerprints[k] = value_fingerprint(self.value_cache[k])
+        return self.value_fingerprints[k]
+
+    def memo_key(self, k):
+        '''Key a result by its code and the upstream values it read'''
+        parents = []
+        for cid in sorted(self.dep_parents.get(k, ())):
+            fingerprint = self.get_fingerprint(cid)
+            if fingerprint is None:
+                return None
+            parents.append((cid, fingerprint))
+        return code_fingerprint(self.code_cache.get(k, '')), tuple(parents)
+
+    def reuse_memoized(self, k):
+        '''Reuse the result of a stale cell if its key has not changed
+
+        Upstream cells are brought up to date first; when they produce the
+        same values and only whitespace or comments of the cell changed,
+        the cached result stands and the cell is no longer stale, which
+        also stops the recomputation from reaching its downstream cells.
+        '''
+        if not self.memoize or self.memo_keys.get(k) is None:
+            return False
+        if k not in self.value_cache and not (
+                self._spill_store is not None and k in self._spill_store and
+                self.restore_value(k)):
+            return False
+        for cid in list(self.dep_parents.get(k, ())):
+            self.get_value(cid)
+        if self.memo_key(k) != self.memo_keys[k]:
+            return False
+        self.set_not_stale(k)
+        # a code change dropped the names this cell exports
+        value = self.value_cache[k]
+        if isinstance(value, LinkedResult):
+            for tag in value.keys():
+                self.shell.dataflow_state.add_link(tag, k)
+        return True
+
+    def begin_journal(self):
+        self.journals.append({})
+        self.ref_memos.append({})
+
+    def end_journal(self, rollback=False):
+        '''Close the innermost journal, removing its edges on rollback'''
+        self.ref_memos.pop(-1)
+        journal = self.journals.pop(-1)
+        if rollback:
+            for parent, child in journal:
+                self.remove_dependencies(parent, child)
 
     def update_dependencies(self, parent, child):
-        self.storeditems.append({'parent':parent, 'child':child})
-        self.dep_parents[child].add(parent)
-        self.dep_children[parent].add(child)
+        if parent not in self.dep_parents[child]:
+            self.dep_parents[child].add(parent)
+            self.dep_children[parent].add(child)
+            self.dep_index.add_edge(parent, child)
+            if self.journals:
+                self.journals[-1][(parent, child)] = None
         if parent not in self.dep_semantic_parents[child]:
             self.dep_semantic_parents[child][parent] = set([parent])
 
@@ -122,6 +454,8 @@ class DataflowHistoryManager(object):
             self.dep_semantic_parents[child][parent].add(item)
 
     def remove_dependencies(self, parent, child):
+        if parent in self.dep_parents[child]:
+            self.dep_index.remove_edge(parent, child)
         self.remove_dep(parent, child, self.dep_parents, self.dep_children)
 
     def remove_semantic_dependencies(self, parent, child,item=None):
@@ -146,19 +480,12 @@ class DataflowHistoryManager(object):
 
 
     def get_all_upstreams(self, k, semantic=False):
-        visited = set()
-        res = set(self.get_semantic_upstream(k)) if semantic else set()
-        frontier = list(self.dep_parents[k])
-        while frontier:
-            cid = frontier.pop(0)
-            visited.add(cid)
-            if semantic:
-                res.update(self.get_semantic_upstream(cid))
-            else:
-                res.add(cid)
-            for pid in self.dep_parents[cid]:
-                if pid not in visited:
-                    frontier.append(pid)
+        upstream = self.dep_index.get_upstream(k)
+        if not semantic:
+            return list(upstream)
+        res = set(self.get_semantic_upstream(k))
+        for cid in upstream:
+            res.update(self.get_semantic_upstream(cid))
         return list(res)
 
 
@@ -166,17 +493,7 @@ class DataflowHistoryManager(object):
         return self.get_all_downstream(k)
 
     def get_all_downstream(self, k):
-        visited = set()
-        res = set()
-        frontier = list(self.dep_children[k])
-        while frontier:
-            cid = frontier.pop(0)
-            visited.add(cid)
-            res.add(cid)
-            for pid in self.dep_children[cid]:
-                if pid not in visited:
-                    frontier.append(pid)
-        return list(res)
+        return list(self.dep_index.get_downstream(k))
 
     def get_downstream(self, k):
         return list(self.dep_children[k])
@@ -207,6 +524,84 @@ class DataflowHistoryManager(object):
                 # stack that are internal (get_item, etc.)
                 retval.raise_error()
 
+    def topological_order(self, cells, key=None):
+        '''Order cells so each comes after its parents among them
+
+        Ties go to the smallest key (the cell id by default).
+        '''
+        if key is None:
+            key = lambda cid: cid
+        indegree = {cid: len(self.dep_parents[cid] & cells) for cid in cells}
+        ready = [(key(cid), cid) for cid, n in indegree.items() if n == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            _, cid = heapq.heappop(ready)
+            order.append(cid)
+            for child in self.dep_children.get(cid, ()):
+                if child in indegree:
+                    indegree[child] -= 1
+                    if indegree[child] == 0:
+                        heapq.heappush(ready, (key(child), child))
+        return order
+
+    def stale_upstream(self, k, parents=None):
+        '''Stale cells that k reads through, in the order they need to run
+
+        The walk starts from the parents of k (or the given cells) and
+        stops at up-to-date and force cached cells since their results are
+        used as they are. Returns the ordered cells and the up-to-date
+        cells they read.
+        '''
+        if parents is None:
+            parents = self.dep_parents.get(k, ())
+        stale = set()
+        inputs = set()
+        seen = set()
+        frontier = deque(parents)
+        while frontier:
+            cid = frontier.popleft()
+            if cid in seen or cid == k:
+                continue
+            seen.add(cid)
+            if self.is_stale(cid) and not self.force_cached_flags.get(cid):
+                stale.add(cid)
+                frontier.extend(self.dep_parents.get(cid, ()))
+            else:
+                inputs.add(cid)
+        return self.topological_order(stale), inputs
+
+    def batch_order(self, targets):
+        '''Cells to run for a batch of targets
+
+        The targets always run, along with the stale cells they read
+        through, in topological order; cells the graph does not order
+        keep the order of targets. Returns the ordered cells and the
+        up-to-date cells they read.
+        '''
+        cells = set(targets)
+        inputs = set()
+        for k in targets:
+            stale, k_inputs = self.stale_upstream(k)
+            cells.update(stale)
+            inputs.update(k_inputs)
+        rank = {cid: i for i, cid in enumerate(targets)}
+        order = self.topological_order(
+            cells, key=lambda cid: (rank.get(cid, -1), cid))
+        return order, inputs - cells
+
+    def update_upstream(self, k):
+        '''Bring the cells k reads up to date before k runs
+
+        Each stale upstream cell runs once, after all of its own stale
+        parents, instead of being recomputed as references are hit.
+        '''
+        order, inputs = self.stale_upstream(k)
+        self.restore_values(inputs)
+        for cid in order:
+            if self.is_stale(cid):
+                self.execute_cell(cid)
+
     def execute_cell(self, k, **flags):
         # print("EXECUTING CELL", k)
         local_flags = dict(self.flags)
@@ -215,6 +610,11 @@ class DataflowHistoryManager(object):
         for cid in self.dep_parents[k]:
             if cid in self.dep_children[k]:
                 raise CyclicalCallError(k)
+        if k in self.failed_cells:
+            raise DataflowCellException(k)
+        self.update_upstream(k)
+        if self.reuse_memoized(k):
+            return self.value_cache[k]
         child_uuid = self.shell.uuid
         retval = self.shell.run_cell_as_execute_request(self.code_cache[k], k,
                                                    **self.flags)
@@ -225,20 +625,73 @@ class DataflowHistoryManager(object):
         # FIXME can we just rely on run_cell?
         return retval.result
 
+    def auto_update_order(self, k):
+        '''Auto-update cells reachable from k through auto-update cells,
+        in topological order'''
+        cells = set()
+        frontier = deque([k])
+        while frontier:
+            cid = frontier.popleft()
+            for child in self.dep_children.get(cid, ()):
+                if (child not in cells and child != k and
+                        self.auto_update_flags.get(child)):
+                    cells.add(child)
+                    frontier.append(child)
+        return self.topological_order(cells)
+
     def run_auto_updates(self, k):
-        for cid in self.get_downstream(k):
-            if self.auto_update_flags[cid]:
-                upstreams = self.get_all_upstreams(cid)
-                if all(not self.is_stale(upcid) or self.auto_update_flags[upcid]
-                       for upcid in upstreams):
-                    retval = self.execute_cell(cid)
+        '''Recompute the auto-update cells downstream of k
+
+        The cascade is planned once and each cell runs at most once, after
+        all of its parents. A cell runs if one of its parents ran in this
+        cascade and none of its other parents is stale (unless it updates
+        automatically too). When the shell sets a cell count or time budget,
+        the cells left over are marked stale and returned.
+        '''
+        if k in self.auto_update_cascade:
+            # already part of a running cascade
+            return []
+        order = self.auto_update_order(k)
+        max_cells = getattr(self.shell, 'auto_update_max_cells', 0)
+        time_limit = getattr(self.shell, 'auto_update_time_limit', 0)
+        start_time = time.perf_counter()
+        executed = {k}
+        self.auto_update_cascade.update(order)
+        self.auto_update_cascade.add(k)
+        try:
+            for i, cid in enumerate(order):
+                parents = self.dep_parents[cid]
+                if executed.isdisjoint(parents):
+                    continue
+                if not all(pid in executed or not self.is_stale(pid) or
+                           self.auto_update_flags.get(pid) for pid in parents):
+                    continue
+                if ((max_cells and len(executed) - 1 >= max_cells) or
+                        (time_limit and
+                         time.perf_counter() - start_time >= time_limit)):
+                    skipped = order[i:]
+                    self.set_stale_all(skipped)
+                    return skipped
+                self.execute_cell(cid)
+                executed.add(cid)
+        finally:
+            self.auto_update_cascade.difference_update(order)
+            self.auto_update_cascade.discard(k)
+        return []
+
+    def ref_memo(self):
+        return self.ref_memos[-1] if self.ref_memos else None
 
     def __getitem__(self, k):
+        # the dependency is registered on the first access in an execution
+        memo = self.ref_memo()
+        if memo is not None and k in memo:
+            return memo[k]
         res = self.get_item(k)
-        if isinstance(res, LinkedResult):
-            if res.__tuple__() is None:
-                return res
-            return res.__tuple__()
+        if isinstance(res, LinkedResult) and res.__tuple__() is not None:
+            res = res.__tuple__()
+        if memo is not None:
+            memo[k] = res
         return res
 
     def stale_check(self, k):
@@ -248,9 +701,16 @@ class DataflowHistoryManager(object):
     def get_item(self, k):
         self.stale_check(k)
         self.update_dependencies(k, self.shell.uuid)
+        return self.get_value(k)
+
+    def get_value(self, k):
         # if k in self.value_cache:
         #     print(k, "in cache", self.value_cache[k])
 
+        if (k not in self.value_cache and self._spill_store is not None and
+                k in self._spill_store):
+            self.restore_value(k)
+
         # force recompute
         if self.force_cached_flags[k]:
             if k not in self.value_cache:
@@ -258,13 +718,23 @@ class DataflowHistoryManager(object):
             # print("returning cache", k)
             return self.value_cache[k]
 
-        # check if we need to recompute
-        if not self.is_stale(k):
+        # check if we need to recompute (or the result was evicted)
+        if not self.is_stale(k) and k in self.value_cache:
             # print("returning not stale cache", k)
             return self.value_cache[k]
         # print('executing cell', k)
         return self.execute_cell(k)
 
+    def cached_value(self, k):
+        '''The stored result of k, without running the cell
+
+        Raises KeyError if the result was evicted and not spilled.
+        '''
+        if (k not in self.value_cache and self._spill_store is not None and
+                k in self._spill_store):
+            self.restore_value(k)
+        return self.value_cache[k]
+
     def __setitem__(self, key, value):
         class InvalidCellModification(KeyError):
             '''This error results when another cell tries to modify an Out reference'''
@@ -384,6 +854,11 @@ class DataflowState:
         self.all_links = defaultdict(set) # most recent is last
         self.rev_links = defaultdict(set)
         self.cur_cell_id = None
+        # bumped whenever the links change so reference conversions
+        # can be cached against it, see version
+        self._version = 0
+        self.link_versions = {} # name -> version of its last change
+        self._touched = {} # name -> link_state before it was touched
 
     def set_cur_cell_id(self, cell_id):
         self.cur_cell_id = cell_id
@@ -435,11 +910,13 @@ class DataflowState:
                 # can make current because unambiguous
                 cell_id = next(iter(self.all_links[tag]))
                 # print('ADDING TAG (ADD_LINKS):', cell_id, tag)
+                self.touch_link(tag)
                 self.links[tag].append(cell_id)
 
     def add_link(self, tag, cell_id, make_current=True):
         # print("OUTER ADD_LINK:", cell_id, tag)
         if isinstance(tag, str):
+            self.touch_link(tag)
             self.all_links[tag].add(cell_id)
             self.rev_links[cell_id].add(tag)
             if make_current:
@@ -450,6 +927,7 @@ class DataflowState:
         # print(f"{cell_id} LINKS: {self.links} REV LINKS: {self.rev_links} ALL_LINKS: {self.all_links}")
         if cell_id in self.rev_links:
             for name in self.rev_links[cell_id]:
+                self.touch_link(name)
                 if cell_id in self.links[name]:
                     self.links[name].remove(cell_id)
                 self.all_links[name].discard(cell_id)
@@ -500,9 +978,43 @@ class DataflowState:
         return results
 
     def clear(self):
+        version = self.version + 1
         self.links.clear()
         self.all_links.clear()
         self.rev_links.clear()
+        self._version = version
+        for name in self.link_versions:
+            self.link_versions[name] = version
+
+    def link_state(self, name):
+        return (tuple(self.links.get(name, ())),
+                frozenset(self.all_links.get(name, ())))
+
+    def touch_link(self, name):
+        '''Call before changing the links of name'''
+        if name not in self._touched:
+            self._touched[name] = self.link_state(name)
+
+    @property
+    def version(self):
+        '''Moves forward only when links end up different, so resetting a
+        cell and adding back the same links leaves it unchanged'''
+        self._settle_touched()
+        return self._version
+
+    def _settle_touched(self):
+        changed = [name for name, state in self._touched.items()
+                   if self.link_state(name) != state]
+        self._touched.clear()
+        if changed:
+            self._version += 1
+            for name in changed:
+                self.link_versions[name] = self._version
+
+    def changed_links(self, version):
+        """Names whose links changed after the given version"""
+        self._settle_touched()
+        return {name for name, v in self.link_versions.items() if v > version}
 
 class DataflowNamespace(dict):
     def clear(self):
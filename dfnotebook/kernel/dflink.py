@@ -21,7 +21,18 @@ class LinkedResult(OrderedDict):
     def get_uuid(self):
         return self.__uuid__
 
+    def __reduce__(self):
+        # rebuild with none_flag set so the items are kept as they are
+        return (self.__class__,
+                (self.__uuid__, self.__libs__, True, list(self.items())))
+
     def __update_deps__(self, item):
+        memo = self.__dfhist__.ref_memo()
+        if memo is not None:
+            # already registered by this execution
+            if (self.__uuid__, item) in memo:
+                return
+            memo[(self.__uuid__, item)] = None
         self.__dfhist__.update_semantic_dependencies(self.__uuid__,
                                                      self.__dfhist__.shell.uuid,
                                                      item)
@@ -56,9 +67,10 @@ class LinkedResult(OrderedDict):
 
 
 class DFTuple(tuple):
-    def __new__(self, __linked, *args, **kwargs):
-        self.__ref__ = __linked
-        return super().__new__(self, *args, **kwargs)
+    def __new__(cls, __linked, *args, **kwargs):
+        obj = super().__new__(cls, *args, **kwargs)
+        obj.__ref__ = __linked
+        return obj
 
     def __getitem__(self, item):
         return self.__ref__.__getitem__(item)
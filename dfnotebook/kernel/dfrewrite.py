@@ -0,0 +1,104 @@
+"""Rewriting of dataflow references in cell code."""
+
+from collections import defaultdict, namedtuple
+
+from dfnbutils import (
+    DataflowRef,
+    convert_dollar,
+    dollar_replacer,
+    ground_refs,
+    identifier_replacer,
+    ref_replacer,
+    run_replacer,
+)
+
+CellRewrite = namedtuple('CellRewrite', ['code', 'dollar_code',
+                                         'persistent_code', 'display_code',
+                                         'identifier_refs'])
+
+
+def freeze_tags(tags):
+    '''Hashable form of an input_tags/output_tags style mapping'''
+    return frozenset((k, frozenset(v) if isinstance(v, (set, list)) else v)
+                     for k, v in tags.items())
+
+
+def _recording(replace_f, refs):
+    def replacer(ref):
+        refs.append(ref)
+        return replace_f(ref)
+    return replacer
+
+
+def _to_source_positions(refs, replaced):
+    '''Map refs found in code where replaced were substituted by
+    identifier_replacer back to positions in the original source'''
+    shifts = defaultdict(list) # line -> [(end column after rewriting, delta)]
+    for ref in sorted(replaced, key=lambda r: r.start_pos):
+        line, start = ref.start_pos
+        delta = len(identifier_replacer(ref)) - (ref.end_pos[1] - start)
+        offset = sum(d for _, d in shifts[line])
+        shifts[line].append((ref.end_pos[1] + offset + delta, delta))
+    res = []
+    for ref in refs:
+        line, start = ref.start_pos
+        offset = sum(d for end, d in shifts[line] if end <= start)
+        res.append(DataflowRef(
+            start_pos=(line, start - offset),
+            end_pos=(ref.end_pos[0], ref.end_pos[1] - offset),
+            name=ref.name, cell_id=ref.cell_id, cell_tag=ref.cell_tag,
+            ref_qualifier=ref.ref_qualifier))
+    return res
+
+
+def _dollar(input_tags):
+    def replacer(ref):
+        ref.input_tags = input_tags
+        return dollar_replacer(ref)
+    return replacer
+
+
+def rewrite_cell(code, dataflow_state, uuid, input_tags={}, output_tags={}):
+    '''Resolve the references in a cell once and render every view of it
+
+    The cell is tokenized once for its $ references and parsed once for
+    the bare identifiers that refer to other cells; each view substitutes
+    the same resolved references into the source:
+
+    * code: the executed code, references as _oh['cell_id']['name']
+    * dollar_code: name$tag or name$cell_id, as sent back in code_dict
+    * persistent_code: name$cell_id, as saved with the notebook
+    * display_code: like dollar_code, but leaves names exported by a
+      single cell bare
+    * identifier_refs: cell_id -> set of names referenced
+
+    Raises SyntaxError or TokenError like the dfnbutils conversions.
+    '''
+    dollar_refs = []
+    parsed_code = convert_dollar(code, dataflow_state, uuid,
+                                 _recording(identifier_replacer, dollar_refs),
+                                 input_tags)
+    grounded = []
+    ground_refs(parsed_code, dataflow_state, uuid,
+                _recording(identifier_replacer, grounded), input_tags,
+                output_tags=output_tags)
+    grounded = _to_source_positions(grounded, dollar_refs)
+    refs = dollar_refs + grounded
+
+    # names exported by a single cell are shown bare
+    display_refs = dollar_refs + [
+        ref for ref in grounded
+        if not (dataflow_state.has_external_link(ref.name, uuid) and
+                len(output_tags.get(ref.name, ())) == 1 and
+                ref.cell_id in output_tags[ref.name])]
+
+    identifier_refs = {}
+    for ref in refs:
+        identifier_refs.setdefault(ref.cell_id, set()).add(ref.name)
+
+    return CellRewrite(
+        code=run_replacer(code, refs, ref_replacer),
+        dollar_code=run_replacer(code, refs, _dollar(input_tags)),
+        persistent_code=run_replacer(code, refs, _dollar({})),
+        display_code=run_replacer(code, display_refs, _dollar(input_tags)),
+        identifier_refs=identifier_refs)
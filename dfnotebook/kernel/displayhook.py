@@ -1,18 +1,55 @@
 """Replacements for ipykernel.displayhook."""
 
+import hashlib
+import json
+import reprlib
 import sys
+import time
+from collections import OrderedDict
 
 from ipykernel.displayhook import ZMQShellDisplayHook as ipyZMQShellDisplayHook
 from ipykernel.displayhook import ZMQDisplayHook
 from ipykernel.jsonutil import encode_images, json_clean
+from traitlets import Bool, Dict
 
+from .dataflow import value_size
 from .dflink import LinkedResult
 
+def output_digest(format_dict, md_dict):
+    """Digest of an output as formatted, before images are encoded"""
+    h = hashlib.sha1()
+    for mimetype in sorted(format_dict):
+        data = format_dict[mimetype]
+        h.update(mimetype.encode())
+        if isinstance(data, bytes):
+            h.update(data)
+        elif isinstance(data, str):
+            h.update(data.encode())
+        else:
+            h.update(json.dumps(data, sort_keys=True, default=repr).encode())
+    h.update(json.dumps(md_dict, sort_keys=True, default=repr).encode())
+    return h.hexdigest()
+
 # Updated to consider format_dict/md_dict as a dictionary of dictionaries
 # This allows us to follow the original code, adding loops
 # to handle multiple outputs
 
 class ZMQShellDisplayHook(ipyZMQShellDisplayHook):
+    # set per request by clients that handle dataflow_execute_result
+    batch_outputs = Bool(False)
+    # set per request by clients that keep outputs marked unchanged
+    dedup_outputs = Bool(False)
+    # uuid -> {output_tag or "": output_digest} of the outputs the client shows
+    output_digests = Dict()
+    # set per request by clients that read binary data from message buffers
+    binary_outputs = Bool(False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # uuid -> output tags sent as previews; the results themselves are
+        # looked up in the history manager when they are rendered
+        self.deferred_outputs = {}
+
     def get_execution_count(self):
         raise NotImplementedError()
 
@@ -29,29 +66,118 @@ class ZMQShellDisplayHook(ipyZMQShellDisplayHook):
             self.shell.dataflow_state.add_link(res_tag, result.__uuid__)
 
     # from IPython.core.displayhook
+    # updated to defer outputs over the shell's formatting budgets
     def compute_format_data(self, result):
         # we assume we either get a LinkedResult or a "normal" result
         format_dicts = {}
         md_dicts = {}
-        if not isinstance(result, LinkedResult):
+        if isinstance(result, LinkedResult):
+            uuid = result.__uuid__
+        else:
+            uuid = self.shell.uuid
             # make non-linked result look like a linked result
             result = {None: result}
+        deferred = set()
+        size_limit = self.shell.output_size_limit
+        time_limit = self.shell.output_format_time_limit
+        start_time = time.monotonic()
         for i, (res_tag, res) in enumerate(result.items()):
-            format_dict, md_dict = super().compute_format_data(res)
+            if ((time_limit and time.monotonic() - start_time > time_limit) or
+                    (size_limit and value_size(res, depth=0) > size_limit)):
+                format_dict, md_dict = self.compute_preview(res), {}
+                is_deferred = True
+            else:
+                format_dict, md_dict = super().compute_format_data(res)
+                is_deferred = self.limit_mimetypes(format_dict)
+            if is_deferred:
+                md_dict["deferred"] = True
+                deferred.add(res_tag)
             if res_tag is not None:
                 md_dict["output_tag"] = res_tag
             format_dicts[i] = format_dict
             md_dicts[i] = md_dict
+        if deferred:
+            self.deferred_outputs[uuid] = deferred
+        else:
+            self.deferred_outputs.pop(uuid, None)
         return format_dicts, md_dicts
 
+    def compute_preview(self, res):
+        """Format only a truncated text/plain repr of res."""
+        preview = reprlib.Repr()
+        preview.maxstring = preview.maxother = self.shell.output_preview_length
+        return {"text/plain": preview.repr(res)}
+
+    def limit_mimetypes(self, format_dict):
+        """Drop representations over the shell's output_mimetype_limit.
+
+        Returns whether any representation was dropped.
+        """
+        limit = self.shell.output_mimetype_limit
+        if not limit:
+            return False
+        dropped = [mimetype for mimetype, data in format_dict.items()
+                   if mimetype != "text/plain" and
+                   isinstance(data, (str, bytes)) and len(data) > limit]
+        for mimetype in dropped:
+            del format_dict[mimetype]
+        return bool(dropped)
+
+    def render_deferred(self, uuid, output_tag):
+        """Fully format an output that was sent as a preview.
+
+        Raises KeyError if the output of the cell was not deferred or its
+        result is no longer cached.
+        """
+        if output_tag not in self.deferred_outputs[uuid]:
+            raise KeyError(output_tag)
+        res = self.shell.dataflow_history_manager.cached_value(uuid)
+        if output_tag is not None:
+            # read the item without recording a dependency
+            res = OrderedDict.__getitem__(res, output_tag)
+        format_dict, md_dict = super().compute_format_data(res)
+        if output_tag is not None:
+            md_dict["output_tag"] = output_tag
+        return json_clean(encode_images(format_dict)), md_dict
+
     # from ipykernel.ipykernel.displayhook
+    # updated to mark outputs the client already shows as unchanged and to
+    # move binary data to message buffers
     def write_format_data(self, format_dicts, md_dicts=None):
         if self.msg:
             new_format_dicts = {}
+            # i -> {mimetype: bytes} sent as buffers instead of base64
+            buffers = {}
+            if md_dicts is None:
+                md_dicts = {}
+            digests = None
+            if self.dedup_outputs:
+                digests = self.output_digests.get(self.shell.uuid) or {}
             for i, format_dict in format_dicts.items():
+                if digests is not None:
+                    md_dict = md_dicts.setdefault(i, {})
+                    digest = output_digest(format_dict, md_dict)
+                    output_tag = md_dict.get("output_tag")
+                    if digests.get(output_tag or "") == digest:
+                        new_format_dicts[i] = {}
+                        md_dicts[i] = {"unchanged": True}
+                        if output_tag is not None:
+                            md_dicts[i]["output_tag"] = output_tag
+                        continue
+                    md_dict["output_digest"] = digest
+                if self.binary_outputs:
+                    binary = {mimetype: data
+                              for mimetype, data in format_dict.items()
+                              if isinstance(data, (bytes, bytearray, memoryview))}
+                    if binary:
+                        buffers[i] = binary
+                        format_dict = {mimetype: data
+                                       for mimetype, data in format_dict.items()
+                                       if mimetype not in binary}
                 new_format_dicts[i] = json_clean(encode_images(format_dict))
             self.msg["content"]["data"] = new_format_dicts
             self.msg["content"]["metadata"] = md_dicts
+            self.msg["buffers"] = buffers
 
     # from ipykernel.ipykernel.displayhook
     def finish_displayhook(self):
@@ -60,13 +186,56 @@ class ZMQShellDisplayHook(ipyZMQShellDisplayHook):
         sys.stderr.flush()
         if self.msg and self.msg["content"]["data"] and self.session:
             format_dicts = self.msg["content"]["data"]
-            md_dicts = self.msg["content"]["metadata"]            
+            md_dicts = self.msg["content"]["metadata"]
+            buffers = self.msg.pop("buffers", None) or {}
+            if self.batch_outputs and len(format_dicts) > 1:
+                self.send_batched(format_dicts, md_dicts, buffers)
+                self.msg = None
+                return
+            content = self.msg["content"]
             for i, format_data in format_dicts.items():
-                self.msg["content"]["data"] = format_data
-                self.msg["content"]["metadata"] = md_dicts.get(i, None)
-                self.session.send(self.pub_socket, self.msg, ident=self.topic)
+                content["data"] = format_data
+                content["metadata"] = md_dicts.get(i, None)
+                binary = buffers.get(i, {})
+                if binary:
+                    content["buffer_paths"] = [["data", mimetype]
+                                               for mimetype in binary]
+                else:
+                    content.pop("buffer_paths", None)
+                self.session.send(self.pub_socket, self.msg, ident=self.topic,
+                                  buffers=list(binary.values()))
         self.msg = None
 
+    def send_batched(self, format_dicts, md_dicts, buffers):
+        """Send all outputs of a LinkedResult as one dataflow_execute_result
+        message, with data and metadata keyed by output_tag."""
+        output_tags = []
+        data = {}
+        metadata = {}
+        buffer_paths = []
+        buffer_data = []
+        for i, format_data in format_dicts.items():
+            md_dict = md_dicts.get(i) or {}
+            tag = md_dict["output_tag"]
+            output_tags.append(tag)
+            data[tag] = format_data
+            metadata[tag] = md_dict
+            for mimetype, buf in buffers.get(i, {}).items():
+                buffer_paths.append(["data", tag, mimetype])
+                buffer_data.append(buf)
+        content = {
+            "execution_count": self.msg["content"].get("execution_count"),
+            "output_tags": output_tags,
+            "data": data,
+            "metadata": metadata,
+        }
+        if buffer_paths:
+            content["buffer_paths"] = buffer_paths
+        msg = self.session.msg("dataflow_execute_result", content,
+                               parent=self.parent_header)
+        self.session.send(self.pub_socket, msg, ident=self.topic,
+                          buffers=buffer_data)
+
     # from IPython.core.displayhook
     # updated to remove underscore refs
     def update_user_ns(self, result):
@@ -97,8 +266,7 @@ class ZMQShellDisplayHook(ipyZMQShellDisplayHook):
             gc.collect()
 
     def cull_cache(self):
-        # FIXME need to decide what to do here
-        # due to the dataflow, we can't necessarily remove
-        # whatever we feel like here...
-        pass
+        # due to the dataflow, we can't remove whatever we feel like here,
+        # the history manager knows which results can be recomputed
+        self.shell.dataflow_history_manager.cull_cache()
 
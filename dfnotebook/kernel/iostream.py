@@ -1,8 +1,38 @@
 import ipykernel.iostream
 
+# added to the parent header a stream buffer is keyed by, so the text each
+# cell writes is buffered apart and flushed with that cell's execution_count
+_UUID_KEY = '__dfkernel_uuid__'
+
 class OutStream(ipykernel.iostream.OutStream):
+    _flush_execution_count = None
+
+    @property
+    def parent_header(self):
+        parent = ipykernel.iostream.OutStream.parent_header.fget(self)
+        try:
+            execution_count = self.get_execution_count()
+        except NotImplementedError:
+            return parent
+        return {**parent, _UUID_KEY: execution_count}
+
+    @parent_header.setter
+    def parent_header(self, value):
+        ipykernel.iostream.OutStream.parent_header.fset(self, value)
+
+    def _flush_buffers(self):
+        # runs in the IO thread; _flush sends each message before asking
+        # for the next buffer, so uuid_hook sees the count of its buffer
+        for parent, data in super()._flush_buffers():
+            self._flush_execution_count = parent.pop(_UUID_KEY, None)
+            yield parent, data
+        self._flush_execution_count = None
+
     def uuid_hook(self, msg):
-        msg['content']['execution_count'] = self.get_execution_count()
+        execution_count = self._flush_execution_count
+        if execution_count is None:
+            execution_count = self.get_execution_count()
+        msg['content']['execution_count'] = execution_count
         return msg
 
     def add_uuid_hook(self, get_execution_count):
@@ -8,9 +8,12 @@ from tokenize import TokenError
 """The IPython kernel implementation"""
 
 import ast
+import hashlib
+import re
 import sys
 import time
 import inspect
+from types import SimpleNamespace
 
 from traitlets import Type
 from ipykernel.jsonutil import json_clean
@@ -23,7 +26,8 @@ try:
 except ImportError:
     _asyncio_runner = None
 
-from .zmqshell import ZMQInteractiveShell
+from .dfrewrite import freeze_tags, rewrite_cell
+from .zmqshell import DataflowCachingCompiler, ZMQInteractiveShell
 from dfnbutils import (
     ground_refs,
     convert_dollar,
@@ -31,10 +35,26 @@ from dfnbutils import (
     ref_replacer,
     identifier_replacer,
     dollar_replacer,
-    get_references
 )
 
 
+# name$ref, name$^ref, ... as written in cell code
+_DOLLAR_REF = re.compile(r"(\w+)\$[\^=~]?(\w*)")
+
+
+def _cells_delta(old, new, max_moved=16):
+    """Cells removed from old and the shortest tail of new such that new is
+    old without both, followed by that tail; None if the tail is long"""
+    new_set = set(new)
+    removed = [cid for cid in old if cid not in new_set]
+    kept = [cid for cid in old if cid in new_set]
+    for n in range(min(len(new), max_moved) + 1):
+        moved = set(new[len(new) - n:])
+        if [cid for cid in kept if cid not in moved] == new[:len(new) - n]:
+            return {"removed": removed, "appended": new[len(new) - n:]}
+    return None
+
+
 def _accepts_cell_id(meth):
     parameters = inspect.signature(meth).parameters
     cid_param = parameters.get("cell_id")
@@ -45,7 +65,14 @@ def _accepts_cell_id(meth):
 
 class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
     shell_class = Type(ZMQInteractiveShell)
+    compiler_class = Type(DataflowCachingCompiler)
     execution_count = None
+    # version of the frontend's code_dict that the kernel has applied
+    _code_dict_version = None
+    # (input tags, output tags, link version) at the last update_code_cells
+    _code_cells_tags = None
+    # graph data as of the last execute_reply, see encode_graph_reply
+    _graph_version = 0
 
     def __init__(self, **kwargs):
         super(IPythonKernel, self).__init__(**kwargs)
@@ -56,6 +83,11 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
             self.execution_count, 16
         )
         get_ipython().kernel.comm_manager.register_target('dfcode', self.dfcode_comm)
+        get_ipython().kernel.comm_manager.register_target('dfoutput', self.dfoutput_comm)
+        # uuid -> (code and refs, converted code, converted executed code)
+        self._code_cells = {}
+        self._graph_cells = []
+        self._graph_downstreams = {}
         
         # # first use nest_ayncio for nested async, then add asyncio.Future to tornado
         # nest_asyncio.apply()
@@ -88,24 +120,62 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
 
     
     def dfcode_comm(self, comm, msg):
+        """Handle a dfcode comm
+
+        A comm opened with {'persistent': True} stays open and serves any
+        number of requests, each answered with the request_id it carried.
+        Otherwise the comm is closed after answering the first message.
+        """
+        persistent = (msg['content'].get('data') or {}).get('persistent', False)
+
         @comm.on_msg
         def _recv(msg):
+            data = msg['content']['data']
             try:
                 update_latest_executed_code = False
-                dfMetadata = msg['content']['data']['dfMetadata']
+                dfMetadata = data['dfMetadata']
                 self.shell.input_tags = dfMetadata['input_tags']
 
-                if msg['content']['data'].get('updateExecutedCode') and msg['content']['data']['updateExecutedCode']:
+                if data.get('updateExecutedCode') and data['updateExecutedCode']:
                     update_latest_executed_code = True
 
                 code_dict, executed_code_dict = self.update_code_cells(dfMetadata, update_latest_executed_code)
-                comm.send({'code_dict': code_dict, 'executed_code_dict': executed_code_dict})
+                reply = {'code_dict': code_dict, 'executed_code_dict': executed_code_dict}
             except Exception as e:
                 self.log.error('Error in conversion')
                 self.log.error(e)
-                comm.send({'error': str(e)})
+                reply = {'error': str(e)}
+            if 'request_id' in data:
+                reply['request_id'] = data['request_id']
+            try:
+                comm.send(reply)
             finally:
-                comm.close()
+                if not persistent:
+                    comm.close()
+
+    def dfoutput_comm(self, comm, msg):
+        """Handle a dfoutput comm
+
+        The open message names an output sent as a preview, {'uuid': ...,
+        'output_tag': ...}; the reply carries its full data and metadata
+        and the comm is closed.
+        """
+        data = msg['content'].get('data') or {}
+        try:
+            format_dict, md_dict = self.shell.displayhook.render_deferred(
+                data['uuid'], data.get('output_tag'))
+            reply = {'data': format_dict, 'metadata': md_dict}
+        except KeyError:
+            reply = {'error': 'No deferred output {!r} for cell {}'.format(
+                data.get('output_tag'), data.get('uuid'))}
+        except Exception as e:
+            self.log.error('Error in rendering output')
+            self.log.error(e)
+            reply = {'error': str(e)}
+        try:
+            comm.send(reply)
+        finally:
+            comm.close()
 
     async def execute_request(self, stream, ident, parent):
         """handle an execute_request"""
@@ -139,6 +209,18 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
         
         self._output_tags = dict(output_tags)
         self.shell.input_tags = input_tags
+        self.shell.displayhook.batch_outputs = bool(
+            dfkernel_data.get("batch_outputs"))
+        self.shell.displayhook.dedup_outputs = bool(
+            dfkernel_data.get("dedup_outputs"))
+        self.shell.displayhook.output_digests = (
+            dfkernel_data.get("output_digests") or {})
+        self.shell.displayhook.binary_outputs = bool(
+            dfkernel_data.get("binary_outputs"))
+
+        if store_history and not self.update_code_dict_version(dfkernel_data):
+            self.send_code_dict_resync(stream, ident, parent, dfkernel_data)
+            return
 
         self._outer_stream = stream
         self._outer_ident = ident
@@ -149,6 +231,13 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
         self._identifier_refs = {}
         self._persistent_code = {}
 
+        if dfkernel_data.get("batch") and store_history:
+            await self.run_batch(dfkernel_data["batch"], silent, store_history)
+            return
+
+        await self.run_upstream(code, dfkernel_data.get("uuid"), silent,
+                                store_history)
+
         res = await self.inner_execute_request(
             code,
             dfkernel_data.get("uuid"),
@@ -164,8 +253,249 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
         # self._outer_allow_stdin = None
         # self._outer_dfkernel_data = None
 
+    async def run_upstream(self, code, uuid, silent, store_history):
+        """Run the stale cells a cell references before the cell itself
+
+        The plan is made up front from the references in the code, and the
+        cells run one after another at this level in topological order, so
+        the references find up-to-date results instead of each starting a
+        nested execute request. References that only show up at run time
+        still fall back to nested execution.
+        """
+        hist = self.shell.dataflow_history_manager
+        hist.failed_cells.clear()
+        if not store_history or uuid is None:
+            return
+        dfkernel_data = self._outer_dfkernel_data
+        input_tags = dfkernel_data.get("input_tags", {})
+        self.shell.update_dataflow(dfkernel_data, skip_uuid=uuid)
+        try:
+            refs = self.rewrite_cell(code, uuid, input_tags).identifier_refs
+        except (SyntaxError, TokenError):
+            return
+        order, inputs = hist.stale_upstream(uuid, refs.keys())
+        hist.restore_values(inputs)
+        hist.update_flags(store_history=store_history, silent=silent)
+        for cid in order:
+            if not hist.is_stale(cid) or hist.reuse_memoized(cid):
+                continue
+            res = await self.inner_execute_request(
+                hist.code_cache[cid], cid, silent, store_history
+            )
+            if not res.success:
+                hist.failed_cells.add(cid)
+                break
+
+    def encode_graph_reply(self, reply_content, res, dfkernel_data):
+        """Add the cell list and downstream updates to an execute_reply
+
+        When the request asks for reply_mode "delta" and holds the
+        graph_version of the previous reply, only the changes since then
+        are sent: cells_delta (cells removed, and cells moved to or added
+        at the end) and downstream_delta (edges added to and removed from
+        each downstream list that changed), with downstream_keys listing
+        every cell the full reply would have updated. Otherwise the full
+        cells and update_downstreams are sent.
+        """
+        downstreams = {d["key"]: d["data"] for d in res.update_downstreams}
+        if (dfkernel_data.get("reply_mode") == "delta" and
+                dfkernel_data.get("graph_version") == self._graph_version):
+            reply_content["graph_delta"] = True
+            cells_delta = _cells_delta(self._graph_cells, res.cells)
+            if cells_delta is None:
+                reply_content["cells"] = res.cells
+            else:
+                reply_content["cells_delta"] = cells_delta
+            reply_content["downstream_keys"] = list(downstreams)
+            reply_content["downstream_delta"] = []
+            for key, data in downstreams.items():
+                old = self._graph_downstreams.get(key, set())
+                if old != set(data):
+                    reply_content["downstream_delta"].append({
+                        "key": key,
+                        "added": [cid for cid in data if cid not in old],
+                        "removed": sorted(old.difference(data)),
+                    })
+        else:
+            reply_content["cells"] = res.cells
+            reply_content["update_downstreams"] = res.update_downstreams
+            self._graph_downstreams = {}
+        self._graph_cells = list(res.cells)
+        self._graph_downstreams.update(
+            (key, set(data)) for key, data in downstreams.items())
+        self._graph_version += 1
+        reply_content["graph_version"] = self._graph_version
+
+    async def run_batch(self, targets, silent, store_history):
+        """Run a batch of cells in a single request
+
+        The targets run along with the stale cells they read through, each
+        once and in topological order, publishing their outputs under their
+        own execution counts. One execute_reply covers the whole batch: the
+        per-cell graph data goes in "batch", and the cell list, downstream
+        updates, identifier_refs and persistent_code are merged.
+        """
+        hist = self.shell.dataflow_history_manager
+        dfkernel_data = self._outer_dfkernel_data
+        hist.failed_cells.clear()
+        self.shell.update_dataflow(dfkernel_data)
+        targets = [cid for cid in targets if cid in hist.code_cache]
+        target_set = set(targets)
+        order, inputs = hist.batch_order(targets)
+        hist.restore_values(inputs)
+        hist.update_flags(store_history=store_history, silent=silent)
+        results = {}
+        for cid in order:
+            if cid not in target_set and (
+                    not hist.is_stale(cid) or hist.reuse_memoized(cid)):
+                continue
+            res = await self.inner_execute_request(
+                hist.code_cache[cid], cid, silent, store_history,
+                send_reply=False
+            )
+            results[cid] = res
+            if not res.success:
+                hist.failed_cells.add(cid)
+                if self._outer_stop_on_error:
+                    break
+        self.send_batch_reply(results)
+
+    def send_batch_reply(self, results):
+        """Send the execute_reply for run_batch"""
+        dfkernel_data = self._outer_dfkernel_data
+        parent = self._outer_parent
+        reply_content = {
+            "status": "ok",
+            "batch": {},
+            "identifier_refs": self._identifier_refs,
+            "persistent_code": self._persistent_code,
+            "deleted_cells": [],
+            "user_expressions": {},
+            "payload": [],
+        }
+        cells = None
+        downstreams = {}
+        for cid, res in results.items():
+            cell_reply = res.reply_content
+            reply_content["batch"][cid] = entry = {"status": cell_reply["status"]}
+            reply_content["deleted_cells"].extend(cell_reply.get("deleted_cells", []))
+            reply_content["payload"].extend(cell_reply.get("payload", []))
+            if cell_reply["status"] != "ok":
+                reply_content["status"] = cell_reply["status"]
+                for key in ("ename", "evalue", "traceback"):
+                    if key in cell_reply:
+                        reply_content[key] = entry[key] = cell_reply[key]
+            if hasattr(res, "nodes"):
+                entry.update({
+                    "nodes": res.nodes,
+                    "links": res.links,
+                    "upstream_deps": res.all_upstream_deps,
+                    "downstream_deps": res.all_downstream_deps,
+                    "imm_upstream_deps": res.imm_upstream_deps,
+                    "imm_downstream_deps": res.imm_downstream_deps,
+                    "internal_nodes": res.internal_nodes,
+                })
+                cells = res.cells
+                downstreams.update(
+                    (d["key"], d["data"]) for d in res.update_downstreams)
+        if cells is not None:
+            # graph data as of the last cell that ran
+            graph = SimpleNamespace(
+                cells=cells,
+                update_downstreams=[{"key": key, "data": data}
+                                    for key, data in downstreams.items()])
+            self.encode_graph_reply(reply_content, graph, dfkernel_data)
+        if results:
+            reply_content["execution_count"] = int(list(results)[-1], 16)
+        else:
+            reply_content["execution_count"] = None
+        if self._code_dict_version is not None:
+            reply_content["code_dict_version"] = self._code_dict_version
+
+        reply_content = json_clean(reply_content)
+        metadata = self.init_metadata(parent)
+        metadata = self.finish_metadata(parent, metadata, reply_content)
+        self.session.send(
+            self._outer_stream,
+            "execute_reply",
+            reply_content,
+            parent,
+            metadata=metadata,
+            ident=self._outer_ident,
+        )
+        if reply_content["status"] == "error" and self._outer_stop_on_error:
+            self._abort_queues()
+
+    def update_code_dict_version(self, dfkernel_data):
+        """Track the version of the code_dict sent by the frontend
+
+        In delta mode, the code_dict only holds cells that changed since
+        code_dict_base_version and cell_ids lists every cell. Returns False
+        if the delta was computed against a version the kernel never saw.
+        """
+        if dfkernel_data.get("code_dict_mode") == "delta":
+            if dfkernel_data.get("code_dict_base_version") != self._code_dict_version:
+                self._code_dict_version = None
+                return False
+        self._code_dict_version = dfkernel_data.get("code_dict_version")
+        return True
+
+    def send_code_dict_resync(self, stream, ident, parent, dfkernel_data):
+        """Ask the frontend to resend the request with the full code_dict"""
+        self.log.info("code_dict version mismatch, requesting full resync")
+        try:
+            execution_count = int(dfkernel_data.get("uuid"), 16)
+        except (TypeError, ValueError):
+            execution_count = None
+        reply_content = {
+            "status": "aborted",
+            "code_dict_resync": True,
+            "execution_count": execution_count,
+        }
+        metadata = self.init_metadata(parent)
+        metadata = self.finish_metadata(parent, metadata, reply_content)
+        self.session.send(
+            stream,
+            "execute_reply",
+            reply_content,
+            parent,
+            metadata=metadata,
+            ident=ident,
+        )
+
+    def cached_conversion(self, convert, code, uuid, *args):
+        """Run a reference conversion, reusing an earlier result
+
+        The key is the source hash, the cell, the version of the dataflow
+        links and any other arguments the conversion reads, so a change to
+        what a cell exports invalidates every entry at once.
+        """
+        shell = self.shell
+        if shell.conversion_cache_size <= 0:
+            return convert()
+        key = (hashlib.sha1(code.encode()).digest(), uuid,
+               shell.dataflow_state.version) + args
+        cache = shell.conversion_cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        res = convert()
+        cache[key] = res
+        while len(cache) > shell.conversion_cache_size:
+            cache.popitem(last=False)
+        return res
+
+    def rewrite_cell(self, code, uuid, input_tags):
+        """rewrite_cell against the current dataflow state, cached"""
+        return self.cached_conversion(
+            partial(rewrite_cell, code, self.shell.dataflow_state, uuid,
+                    input_tags, self._output_tags),
+            code, uuid, "rewrite", freeze_tags(input_tags),
+            freeze_tags(self._output_tags))
+
     async def inner_execute_request(
-        self, code, uuid, silent, store_history=True, user_expressions=None
+        self, code, uuid, silent, store_history=True, user_expressions=None,
+        send_reply=True,
     ):
         stream = self._outer_stream
         ident = self._outer_ident
@@ -187,55 +517,38 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
             # FIXME for debugging
             uuid = "1"
             execution_count = 1
-        dollar_converted = False
-        orig_code = code
-        parsed_code = ''
+        display_code = code
         try:
-            code = convert_dollar(
-                code, self.shell.dataflow_state, uuid, identifier_replacer, input_tags
-            )
-            dollar_converted = True
-            parsed_code = code;
-            code = ground_refs(
-                code, self.shell.dataflow_state, uuid, identifier_replacer, input_tags, output_tags=self._output_tags
-            )
-            self._identifier_refs[uuid] = get_references(code)
-            self._persistent_code[uuid] = convert_identifier(code, dollar_replacer, input_tags={})
-
-            code = convert_identifier(code, dollar_replacer, input_tags=input_tags)
-            dollar_converted = False
-        except SyntaxError as e:
-            if dollar_converted:
-                code = orig_code
-                parsed_code = ''
-            pass
-        except TokenError as e:
-            # ignore this for now, catch it in do_execute
-            parsed_code = ''
-            pass
+            rewrite = self.rewrite_cell(code, uuid, input_tags)
+        except (SyntaxError, TokenError):
+            rewrite = None
+
+        if rewrite is not None:
+            self._identifier_refs[uuid] = rewrite.identifier_refs
+            self._persistent_code[uuid] = rewrite.persistent_code
+            display_code = rewrite.display_code
 
         #print("FIRST CODE:", code)
         if not silent:
-            if len(parsed_code) > 0:
-                display_code = ground_refs(parsed_code, self.shell.dataflow_state, uuid, identifier_replacer, input_tags, output_tags=self._output_tags, display_code=True)
-                display_code = convert_identifier(display_code, dollar_replacer, input_tags=input_tags)
-                self._publish_execute_input(display_code, parent, execution_count)
-            else:
-                self._publish_execute_input(code, parent, execution_count)
+            self._publish_execute_input(display_code, parent, execution_count)
 
         # update the code_dict with the modified code
-        dfkernel_data["code_dict"][uuid] = code
-        # convert all tilded code
-        try:
-            code = convert_dollar(
-                code, self.shell.dataflow_state, uuid, ref_replacer, input_tags
-            )
-        except SyntaxError as e:
-            # ignore this for now, catch it in do_execute
-            pass
-        except TokenError as e:
-            # ignore this for now, catch it in do_execute
-            pass
+        if rewrite is not None:
+            dfkernel_data["code_dict"][uuid] = rewrite.dollar_code
+            code = rewrite.code
+        else:
+            dfkernel_data["code_dict"][uuid] = code
+            # convert all tilded code
+            try:
+                code = convert_dollar(
+                    code, self.shell.dataflow_state, uuid, ref_replacer, input_tags
+                )
+            except SyntaxError as e:
+                # ignore this for now, catch it in do_execute
+                pass
+            except TokenError as e:
+                # ignore this for now, catch it in do_execute
+                pass
 
         # print("SECOND CODE:", code)
 
@@ -277,6 +590,10 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
         if self._execute_sleep:
             time.sleep(self._execute_sleep)
 
+        if not send_reply:
+            res.reply_content = reply_content
+            return res
+
         # Send the reply.
         reply_content = json_clean(reply_content)
         metadata = self.finish_metadata(parent, metadata, reply_content)
@@ -424,7 +741,6 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
             if hasattr(res, "nodes"):
                 reply_content["nodes"] = res.nodes
                 reply_content["links"] = res.links
-                reply_content["cells"] = res.cells
                 reply_content["identifier_refs"] = self._identifier_refs
                 reply_content["persistent_code"] = self._persistent_code
 
@@ -432,8 +748,15 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
                 reply_content["downstream_deps"] = res.all_downstream_deps
                 reply_content["imm_upstream_deps"] = res.imm_upstream_deps
                 reply_content["imm_downstream_deps"] = res.imm_downstream_deps
-                reply_content["update_downstreams"] = res.update_downstreams
                 reply_content["internal_nodes"] = res.internal_nodes
+                # the frontend only reads the reply for the requested cell,
+                # batches send one reply of their own
+                if (uuid == dfkernel_data.get("uuid") and
+                        not dfkernel_data.get("batch")):
+                    self.encode_graph_reply(reply_content, res, dfkernel_data)
+                else:
+                    reply_content["cells"] = res.cells
+                    reply_content["update_downstreams"] = res.update_downstreams
         else:
             reply_content["status"] = "error"
 
@@ -455,6 +778,8 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
 
         # Return the execution counter so clients can display prompts
         reply_content["execution_count"] = int(uuid, 16)
+        if self._code_dict_version is not None:
+            reply_content["code_dict_version"] = self._code_dict_version
         # reply_content['execution_count'] = shell.execution_count - 1
 
         if "traceback" in reply_content:
@@ -483,7 +808,32 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
 
         return reply_content, res
 
+    def code_cells_changes(self, input_tags, output_tags):
+        """Names, tags and cell ids whose meaning changed since the last
+        update_code_cells call, or None if every cell must be converted"""
+        dataflow_state = self.shell.dataflow_state
+        last = self._code_cells_tags
+        self._code_cells_tags = (dict(input_tags), dict(output_tags),
+                                 dataflow_state.version)
+        if last is None:
+            return None
+        last_input_tags, last_output_tags, last_version = last
+        names = dataflow_state.changed_links(last_version)
+        names.update(name for name in output_tags.keys() | last_output_tags.keys()
+                     if output_tags.get(name) != last_output_tags.get(name))
+        tags = {tag for tag in input_tags.keys() | last_input_tags.keys()
+                if input_tags.get(tag) != last_input_tags.get(tag)}
+        cell_ids = {cell_tags.get(tag) for cell_tags in (input_tags, last_input_tags)
+                    for tag in tags} | tags
+        return names, cell_ids
+
     def update_code_cells(self, dfmetadata, update_latest_executed_code=False):	
+        """Revert references in the notebook's code after tags or outputs change
+
+        Only cells whose code or references changed since the last call, or
+        whose references mention a name, tag or cell that changed, are
+        converted again; the rest reuse their previous result.
+        """
         curr_output_tags = defaultdict(set)
         updated_code_dict = {}
         updated_executed_code_dict = {}
@@ -492,24 +842,52 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
             for tag in tags:
                 curr_output_tags[tag].add(id)
     
+        input_tags = dfmetadata.get("input_tags", {})
+        frozen_tags = freeze_tags(input_tags), freeze_tags(curr_output_tags)
+        changes = self.code_cells_changes(input_tags, curr_output_tags)
+        last_cells = self._code_cells
+        self._code_cells = {}
+
+        def revert_code(code, uuid, tag_refs, cell_refs):
+            code = convert_dollar(
+                code, self.shell.dataflow_state, uuid, identifier_replacer, input_tags, reversion=True, tag_refs=tag_refs
+            )
+
+            code = ground_refs(
+                code, self.shell.dataflow_state, uuid, identifier_replacer, input_tags, output_tags=dict(curr_output_tags), cell_refs=cell_refs, reversion=True
+            )
+
+            return convert_identifier(code, dollar_replacer, input_tags=input_tags)
+
         def convert_code(code, uuid, refs):
+            if not code:
+                return None
             try:
                 tag_refs = { value: key for key, value in refs['tag_refs'].items() }
-                code = convert_dollar(
-                    code, self.shell.dataflow_state, uuid, identifier_replacer, dfmetadata.get("input_tags", {}), reversion=True, tag_refs=tag_refs
-                )
-
-                code = ground_refs(
-                    code, self.shell.dataflow_state, uuid, identifier_replacer, dfmetadata.get("input_tags", {}), output_tags=dict(curr_output_tags), cell_refs=dict(code_refs), reversion=True
-                )
-
-                code = convert_identifier(code, dollar_replacer, input_tags=dfmetadata.get("input_tags", {}))
-                return code
+                cell_refs = dict(code_refs)
+                code = self.cached_conversion(
+                    partial(revert_code, code, uuid, tag_refs, cell_refs),
+                    code, uuid, "revert", *frozen_tags,
+                    freeze_tags(tag_refs), freeze_tags(cell_refs))
             except Exception as e:
                 self.log.error(f'Error in conversion for cell: {uuid}')
                 self.log.error(e)
                 return None
-
+            return code
+
+        def affected(uuid, signature, refs):
+            if changes is None or uuid not in last_cells:
+                return True
+            if last_cells[uuid][0] != signature:
+                return True
+            names, cell_ids = changes
+            if code_refs.keys() & names or refs['ref'].keys() & cell_ids:
+                return True
+            for code in signature[:2]:
+                for name, cell_ref in _DOLLAR_REF.findall(code or ''):
+                    if name in names or cell_ref in cell_ids:
+                        return True
+            return False
 
         for uuid, refs in dfmetadata['all_refs'].items():
             code_refs = defaultdict(set)
@@ -518,14 +896,27 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
                     code_refs[tag].add(ref_id)
             
             if dfmetadata['code_dict'].get(uuid):
-                code = convert_code(dfmetadata['code_dict'][uuid], uuid, refs)
-                if code is not None and code != dfmetadata['code_dict'][uuid]:
-                    updated_code_dict[uuid] = code
-
-                if update_latest_executed_code and dfmetadata['executed_code'].get(uuid):
-                    code = convert_code(dfmetadata['executed_code'][uuid],  uuid, refs)
-                    if code is not None and code != dfmetadata['executed_code'][uuid]:
-                        updated_executed_code_dict[uuid] = code
+                code = dfmetadata['code_dict'][uuid]
+                executed_code = None
+                if update_latest_executed_code:
+                    executed_code = dfmetadata['executed_code'].get(uuid)
+                signature = (code, executed_code, freeze_tags(refs['ref']),
+                             freeze_tags(refs['tag_refs']))
+                if affected(uuid, signature, refs):
+                    converted = convert_code(code, uuid, refs)
+                    if converted == code:
+                        converted = None
+                    executed_converted = convert_code(executed_code, uuid, refs)
+                    if executed_converted == executed_code:
+                        executed_converted = None
+                else:
+                    _, converted, executed_converted = last_cells[uuid]
+                self._code_cells[uuid] = (signature, converted, executed_converted)
+
+                if converted is not None:
+                    updated_code_dict[uuid] = converted
+                if executed_converted is not None:
+                    updated_executed_code_dict[uuid] = executed_converted
 
         return updated_code_dict, updated_executed_code_dict
 
@@ -0,0 +1,80 @@
+"""Disk storage for cell results evicted from the value cache."""
+
+import atexit
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+
+
+class DataflowSpillStore(object):
+    '''Pickles cell results to a scratch directory
+
+    Buffers that support pickle protocol 5 (NumPy arrays, the blocks of
+    pandas frames) are written raw to a separate file and come back as
+    read-only views on a memory map, so they are paged in on demand
+    instead of being copied into memory.
+    '''
+    alignment = 64
+
+    def __init__(self, root):
+        os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix='dfkernel-', dir=root)
+        # key -> (buffer offsets, size of the pickled data)
+        self.entries = {}
+        atexit.register(shutil.rmtree, self.path, True)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _paths(self, key):
+        base = os.path.join(self.path, key)
+        return base + '.pkl', base + '.buf'
+
+    def store(self, key, value):
+        # never rewrite a file in place, old results may still map it
+        self.discard(key)
+        pkl_path, buf_path = self._paths(key)
+        buffers = []
+        data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+        offsets = []
+        with open(buf_path, 'wb') as f:
+            for buf in buffers:
+                raw = buf.raw()
+                f.write(b'\0' * (-f.tell() % self.alignment))
+                offsets.append((f.tell(), raw.nbytes))
+                f.write(raw)
+        with open(pkl_path, 'wb') as f:
+            f.write(data)
+        self.entries[key] = (offsets, len(data))
+
+    def load(self, key):
+        pkl_path, buf_path = self._paths(key)
+        offsets, _ = self.entries[key]
+        buffers = []
+        if offsets and os.path.getsize(buf_path) > 0:
+            with open(buf_path, 'rb') as f:
+                view = memoryview(mmap.mmap(f.fileno(), 0,
+                                            access=mmap.ACCESS_READ))
+            buffers = [view[start:start + size] for start, size in offsets]
+        elif offsets:
+            buffers = [b''] * len(offsets)
+        with open(pkl_path, 'rb') as f:
+            return pickle.load(f, buffers=buffers)
+
+    def resident_size(self, key):
+        '''Memory used by a loaded result apart from its mapped buffers'''
+        return self.entries[key][1]
+
+    def discard(self, key):
+        if self.entries.pop(key, None) is not None:
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        for key in list(self.entries):
+            self.discard(key)
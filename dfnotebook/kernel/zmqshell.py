@@ -9,10 +9,12 @@ import ipykernel.zmqshell
 import ast
 import asyncio
 import collections
+import contextlib
 from functools import partial
 import inspect
 import nest_asyncio
 import sys
+import time
 import types
 from IPython.core import magic_arguments
 from IPython.core.interactiveshell import InteractiveShellABC, \
@@ -23,6 +25,7 @@ except ImportError:
     _asyncio_runner = None
 from IPython.core.interactiveshell import ExecutionResult, ExecutionInfo
 from IPython.core.compilerop import CachingCompiler
+from ipykernel.compiler import XCachingCompiler
 from IPython.core.magic import magics_class, Magics, cell_magic, line_magic, \
     needs_local_scope
 from IPython.core.history import HistoryManager
@@ -32,7 +35,7 @@ from dfnotebook.kernel.dflink import LinkedResult
 from dfnotebook.kernel.displayhook import ZMQShellDisplayHook
 from dfnotebook.kernel.safe_attr import safe_attr
 from traitlets import (
-    Integer, Instance, Type, Unicode, validate
+    Bool, Float, Integer, Instance, Type, Unicode
 )
 from warnings import warn
 from typing import List as ListType, Tuple, Iterable, Optional
@@ -276,6 +279,171 @@ class CellIdTransformer(ast.NodeTransformer):
                 ctx=node.ctx), node)
         return node
 
+def ref_key(node):
+    """Return (cell_id, name) if node is an _oh['cell_id']['name'] load"""
+    if (isinstance(node, ast.Subscript) and
+            isinstance(node.ctx, ast.Load) and
+            isinstance(node.value, ast.Subscript) and
+            isinstance(node.value.value, ast.Name) and
+            node.value.value.id == '_oh' and
+            isinstance(node.value.slice, ast.Constant) and
+            isinstance(node.value.slice.value, str) and
+            isinstance(node.slice, ast.Constant) and
+            isinstance(node.slice.value, str)):
+        return node.value.slice.value, node.slice.value
+    return None
+
+
+class DataflowCachingCompiler(XCachingCompiler):
+    """Compiler that can skip parsing a cell
+
+    Set skip_parse when the compiled closure of the cell is already cached;
+    the next parse then returns an empty module instead.
+    """
+    skip_parse = False
+
+    def ast_parse(self, source, filename='<unknown>', symbol='exec'):
+        if self.skip_parse:
+            self.skip_parse = False
+            return ast.Module([], [])
+        return super().ast_parse(source, filename, symbol)
+
+
+class RecordingCompiler:
+    """Wraps a compiler, keeping the code objects it returns"""
+    def __init__(self, compiler):
+        self.compiler = compiler
+        self.codes = []
+
+    def __call__(self, *args, **kwargs):
+        code = self.compiler(*args, **kwargs)
+        self.codes.append(code)
+        return code
+
+    def extra_flags(self, flags):
+        return self.compiler.extra_flags(flags)
+
+
+class ReplayCompiler:
+    """Returns previously compiled code objects in order"""
+    def __init__(self, codes):
+        self.codes = iter(codes)
+
+    def __call__(self, *args, **kwargs):
+        return next(self.codes)
+
+    def extra_flags(self, flags):
+        return contextlib.nullcontext()
+
+
+class ReferenceHoister:
+    """Bind the upstream references of a cell body to closure locals
+
+    A reference that is evaluated whenever the cell runs is looked up once
+    at the top of the body. One that only some paths reach (branches, loop
+    bodies, handlers, nested functions) stays lazy: its uses load the local
+    and only look it up while the local is still None. Uses where an
+    assignment expression is not allowed keep the original lookup.
+    """
+    # fields whose code does not run every time the node does
+    conditional_fields = {
+        ast.If: ('body', 'orelse'),
+        ast.For: ('body', 'orelse'),
+        ast.AsyncFor: ('body', 'orelse'),
+        ast.While: ('body', 'orelse'),
+        ast.IfExp: ('body', 'orelse'),
+        ast.Assert: ('msg',),
+        ast.ListComp: ('elt', 'generators'),
+        ast.SetComp: ('elt', 'generators'),
+        ast.GeneratorExp: ('elt', 'generators'),
+        ast.DictComp: ('key', 'value', 'generators'),
+    }
+    # everything below these nodes is conditional
+    conditional_nodes = (ast.Try, ast.FunctionDef, ast.AsyncFunctionDef,
+                         ast.Lambda, ast.ClassDef) + \
+        ((ast.Match,) if hasattr(ast, 'Match') else ()) + \
+        ((ast.TryStar,) if hasattr(ast, 'TryStar') else ())
+    # scopes where an assignment expression cannot bind the closure local
+    no_walrus_nodes = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda,
+                       ast.ClassDef)
+
+    def __init__(self):
+        self.refs = {} # (cell_id, name) -> [local name, eager, first node]
+        self.lazy = set()
+
+    def hoist(self, body):
+        for stmt in body:
+            self.visit(stmt, False, True, collect=True)
+        if not self.refs:
+            return body
+        body = [self.visit(stmt, False, True) for stmt in body]
+        bindings = []
+        for key, (local, eager, node) in self.refs.items():
+            if not eager and key not in self.lazy:
+                continue
+            value = node if eager else ast.Constant(None)
+            bindings.append(ast.copy_location(
+                ast.Assign([ast.Name(local, ast.Store())], value), node))
+        return bindings + body
+
+    def visit(self, node, conditional, walrus_ok, collect=False):
+        key = ref_key(node)
+        if key is not None:
+            if collect:
+                if key not in self.refs:
+                    self.refs[key] = ['__dfref{}__'.format(len(self.refs)),
+                                      False, node]
+                self.refs[key][1] |= not conditional
+                return node
+            return self.replace(node, key, walrus_ok)
+        if isinstance(node, self.conditional_nodes):
+            conditional = True
+        if isinstance(node, self.no_walrus_nodes):
+            walrus_ok = False
+        cond_fields = self.conditional_fields.get(type(node), ())
+        for field, value in ast.iter_fields(node):
+            field_cond = conditional or field in cond_fields
+            # comprehension iterables cannot hold assignment expressions
+            field_walrus = walrus_ok and not (
+                isinstance(node, ast.comprehension) and field == 'iter')
+            if isinstance(value, list):
+                for i, item in enumerate(value):
+                    if isinstance(item, ast.AST):
+                        # only the first operand of and/or, and the first
+                        # comparator of a chained comparison, always runs
+                        item_cond = field_cond or i > 0 and (
+                            isinstance(node, ast.BoolOp) or
+                            isinstance(node, ast.Compare) and
+                            field == 'comparators')
+                        value[i] = self.visit(item, item_cond, field_walrus,
+                                              collect)
+            elif isinstance(value, ast.AST):
+                setattr(node, field, self.visit(value, field_cond,
+                                                field_walrus, collect))
+        return node
+
+    def replace(self, node, key, walrus_ok):
+        local, eager, _ = self.refs[key]
+        if eager:
+            return ast.copy_location(ast.Name(local, ast.Load()), node)
+        if not walrus_ok:
+            return node
+        self.lazy.add(key)
+        lookup = ast.NamedExpr(ast.Name(local, ast.Store()),
+                               self.copy_ref(node))
+        return ast.copy_location(ast.IfExp(
+            ast.Compare(ast.Name(local, ast.Load()), [ast.IsNot()],
+                        [ast.Constant(None)]),
+            ast.Name(local, ast.Load()), lookup), node)
+
+    @staticmethod
+    def copy_ref(node):
+        return ast.copy_location(ast.Subscript(
+            ast.Subscript(ast.Name('_oh', ast.Load()),
+                          ast.Constant(node.value.slice.value), ast.Load()),
+            ast.Constant(node.slice.value), ast.Load()), node)
+
+
 class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
     """A subclass of InteractiveShell for ZMQ."""
 
@@ -283,6 +451,76 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
     display_pub_class = Type(ZMQDisplayPublisher)
 
     execution_count = Integer(0)
+    value_cache_limit = Integer(0,
+        help="""Approximate memory budget (in bytes) for cached cell results.
+        When it is exceeded, the results that are cheapest to recompute per
+        byte are dropped and recomputed the next time they are referenced.
+        0 means no limit."""
+    ).tag(config=True)
+    value_cache_spill_dir = Unicode('',
+        help="""Scratch directory for results evicted by value_cache_limit.
+        When set, evicted results are written to disk (array buffers are
+        memory-mapped back) and reloaded when referenced instead of being
+        recomputed. Empty disables spilling."""
+    ).tag(config=True)
+    spill_load_workers = Integer(0,
+        help="""Number of threads used to read spilled upstream results from
+        value_cache_spill_dir concurrently before a stale cell is
+        recomputed. Cells themselves always run one at a time; this only
+        overlaps the disk reads. Values below 2 load them one at a time."""
+    ).tag(config=True)
+    auto_update_max_cells = Integer(0,
+        help="""Maximum number of cells a single auto-update cascade may
+        recompute. Cells beyond the budget are left stale. 0 means no limit."""
+    ).tag(config=True)
+    auto_update_time_limit = Float(0,
+        help="""Wall-clock budget in seconds for a single auto-update
+        cascade. Once it is spent, the remaining cells are left stale.
+        0 means no limit."""
+    ).tag(config=True)
+    closure_cache_size = Integer(128,
+        help="""Number of compiled cell closures to keep. Re-running a cell
+        whose transformed code is cached skips parsing, rewriting and
+        compiling it. 0 disables the cache."""
+    ).tag(config=True)
+    conversion_cache_size = Integer(256,
+        help="""Number of reference conversions to keep. A cell whose source,
+        tags and upstream links are unchanged reuses its rewritten code
+        instead of being tokenized and parsed again. 0 disables the cache."""
+    ).tag(config=True)
+    hoist_references = Bool(True,
+        help="""Bind each distinct upstream reference in a cell to a local
+        variable of the cell closure, so repeated uses are plain local loads.
+        References that are not always evaluated stay lazy."""
+    ).tag(config=True)
+    memoize_results = Bool(False,
+        help="""Reuse the cached result of a stale cell when its code is
+        unchanged apart from whitespace and comments and the upstream values
+        it read hash the same, instead of executing it again. Every
+        execution then pickles and hashes the values its cell read, which
+        costs more than it saves unless cells are slow to run."""
+    ).tag(config=True)
+    output_size_limit = Integer(0,
+        help="""Approximate size (in bytes) above which a cell output is sent
+        as a short text preview instead of being run through every display
+        formatter. The full rendering is fetched through the dfoutput comm.
+        0 means no limit."""
+    ).tag(config=True)
+    output_mimetype_limit = Integer(0,
+        help="""Largest formatted representation (in characters or bytes) sent
+        for a mimetype other than text/plain. Larger representations are
+        left out and can be fetched through the dfoutput comm. 0 means no
+        limit."""
+    ).tag(config=True)
+    output_format_time_limit = Float(0,
+        help="""Time budget in seconds for formatting the outputs of one cell.
+        Once it is spent, the remaining outputs are sent as previews.
+        0 means no limit."""
+    ).tag(config=True)
+    output_preview_length = Integer(1000,
+        help="""Number of characters kept in the preview of an output whose
+        full rendering is deferred."""
+    ).tag(config=True)
     # UUID passed from notebook interface
     uuid = Unicode(allow_none=True)
     dataflow_history_manager = Instance(DataflowHistoryManager)
@@ -298,6 +536,15 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         self.uuid_stack = [] # [None]
         self.result_stack = [] # [None]
         self.execution_count_stack = []
+        self.compute_time_stack = []
+        # (transformed cell, uuid, flags) ->
+        #     (nodes, interactivity, code objects, internal names)
+        self.closure_cache = collections.OrderedDict()
+        self.async_cache = collections.OrderedDict()
+        self._closure_key = None
+        self._closure_entry = None
+        # (source hash, uuid, link version, args) -> converted code
+        self.conversion_cache = collections.OrderedDict()
         self.input_tags = {}
         self.max_execution_count = 0
 
@@ -426,16 +673,6 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         #self.register_magics(FunctionMagics)
         self.register_magics(OutputMagics)
 
-    # FIXME hack to be notified of change before it happens?
-    @validate('uuid')
-    def _uuid_to_change(self, proposal):
-        # print("UUID TO CHANGE TO", proposal['value'], file=sys.__stdout__)
-        if hasattr(sys.stdout, 'get_execution_count'):
-            sys.stdout.flush()
-        if hasattr(sys.stderr, 'get_execution_count'):
-            sys.stderr.flush()
-        return proposal['value']
-
     def push_uuid(self):
         # want self.uuid to be the current uuid at any time (stashing uuid there)
         self.uuid_stack.append(self.uuid)
@@ -490,6 +727,66 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         # print("DONE:", self.uuid, self.execution_count)
         return res
 
+    def cache_put(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.closure_cache_size:
+            cache.popitem(last=False)
+
+    def has_custom_ast_transformers(self):
+        """Whether AST transformers other than CellIdTransformer are
+        registered; they may not depend on the code alone"""
+        return any(not isinstance(t, CellIdTransformer)
+                   for t in self.ast_transformers)
+
+    def lookup_closure(self, transformed_cell, uuid, silent, shell_futures,
+                       preprocessing_exc_tuple):
+        """Find the compiled closure for the next run_ast_nodes call"""
+        self._closure_key = self._closure_entry = None
+        if (not shell_futures or self.closure_cache_size <= 0 or
+                transformed_cell is None or
+                preprocessing_exc_tuple is not None or
+                self.has_custom_ast_transformers()):
+            return
+        self._closure_key = (transformed_cell, uuid, self.compile.flags,
+                             self.autoawait, self.hoist_references,
+                             silent, self.ast_node_interactivity)
+        self._closure_entry = self.closure_cache.get(self._closure_key)
+        if self._closure_entry is not None:
+            self.closure_cache.move_to_end(self._closure_key)
+            self.compile.skip_parse = True
+
+    def should_run_async(self, raw_cell, *, transformed_cell=None,
+                         preprocessing_exc_tuple=None):
+        if (transformed_cell is None or preprocessing_exc_tuple is not None or
+                self.closure_cache_size <= 0):
+            return super().should_run_async(
+                raw_cell, transformed_cell=transformed_cell,
+                preprocessing_exc_tuple=preprocessing_exc_tuple)
+        key = (transformed_cell, self.autoawait)
+        if key in self.async_cache:
+            self.async_cache.move_to_end(key)
+            return self.async_cache[key]
+        res = super().should_run_async(
+            raw_cell, transformed_cell=transformed_cell,
+            preprocessing_exc_tuple=preprocessing_exc_tuple)
+        self.cache_put(self.async_cache, key, res)
+        return res
+
+    def update_dataflow(self, dfkernel_data, skip_uuid=None):
+        """Apply the cell codes, flags and output tags sent by the frontend"""
+        code_dict = dfkernel_data.get("code_dict", {})
+        cell_ids = dfkernel_data.get("cell_ids")
+        if skip_uuid is not None and skip_uuid in code_dict:
+            # keep the cell as it is until its code has been converted
+            cell_ids = list(code_dict) if cell_ids is None else cell_ids
+            code_dict = {k: v for k, v in code_dict.items() if k != skip_uuid}
+        self.dataflow_history_manager.update_codes(code_dict, cell_ids)
+        self.dataflow_history_manager.update_auto_update(
+            dfkernel_data.get("auto_update_flags", []))
+        self.dataflow_history_manager.update_force_cached(
+            dfkernel_data.get("force_cached_flags", []))
+        self.dataflow_state.add_links(dfkernel_data.get("output_tags", {}))
+
     async def run_cell_async_override(self, raw_cell: str, store_history=False,
                              silent=False, shell_futures=True, uuid=None,
                              dfkernel_data={},
@@ -500,9 +797,6 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
                              cell_id=None) -> ExecutionResult:
 
         code_dict = dfkernel_data.get("code_dict", {})
-        output_tags = dfkernel_data.get("output_tags", {})
-        auto_update_flags = dfkernel_data.get("auto_update_flags", [])
-        force_cached_flags = dfkernel_data.get("force_cached_flags", [])
         # print("CODE_DICT:", code_dict)
         # print("ASYNC RUNNING CELL", uuid, raw_cell)
         # print("RUN_CELL USER_NS:", self.user_ns)
@@ -511,14 +805,11 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         old_deps = []
 
         if store_history:
-            self.dataflow_history_manager.update_codes(code_dict)
-            self.dataflow_history_manager.update_auto_update(auto_update_flags)
-            self.dataflow_history_manager.update_force_cached(force_cached_flags)
-            self.dataflow_state.add_links(output_tags)
+            self.update_dataflow(dfkernel_data)
             # also put the current cell into the cache and force recompute
             if uuid not in code_dict:
                 self.dataflow_history_manager.update_code(uuid, raw_cell)
-            if uuid in self.dataflow_history_manager.value_cache and uuid in self.dataflow_history_manager.dep_parents:
+            if uuid in self.dataflow_history_manager.last_calculated and uuid in self.dataflow_history_manager.dep_parents:
                 old_deps = self.dataflow_history_manager.all_upstream(uuid)
                 for i in list(self.dataflow_history_manager.dep_parents[uuid]):
                     self.dataflow_history_manager.remove_dependencies(i,uuid)
@@ -532,12 +823,6 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         result_deleted_cells = self.dataflow_history_manager.deleted_cells
         self.dataflow_history_manager.deleted_cells = []
 
-        #FIXME low priority possibly change how these are calculated, this can probably be moved elsewhere
-        internalnodes = []
-        for node in ast.walk(ast.parse(transformed_cell)):
-            if (isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)):
-                internalnodes.append(node.id)
-
         # before run_ast_nodes runs, have some code to run, used to be in run_cell
         # but should be able to live in run_ast_nodes...
         # need to use a stack instead of the recursion...
@@ -553,20 +838,36 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         self.uuid = uuid
         self.dataflow_state.set_cur_cell_id(self.uuid)
         self.push_result()
-
-        result = await super().run_cell_async(raw_cell,
-                                              store_history=store_history,
-                                              silent=silent,
-                                              shell_futures=shell_futures,
-                                              transformed_cell=transformed_cell,
-                                              preprocessing_exc_tuple=preprocessing_exc_tuple,
-                                              cell_id=cell_id
-                                              )
-
-        self.pop_result()
+        self.compute_time_stack.append(0.0)
+        self.dataflow_history_manager.begin_journal()
+        start_time = time.perf_counter()
+        result = None
+        # the stacks must be popped even if the execution is cancelled
+        try:
+            self.lookup_closure(transformed_cell, uuid, silent, shell_futures,
+                                preprocessing_exc_tuple)
+            result = await super().run_cell_async(raw_cell,
+                                                  store_history=store_history,
+                                                  silent=silent,
+                                                  shell_futures=shell_futures,
+                                                  transformed_cell=transformed_cell,
+                                                  preprocessing_exc_tuple=preprocessing_exc_tuple,
+                                                  cell_id=cell_id
+                                                  )
+        finally:
+            self.compile.skip_parse = False
+            # don't count time spent recomputing upstream cells
+            elapsed = time.perf_counter() - start_time
+            compute_time = elapsed - self.compute_time_stack.pop(-1)
+            if self.compute_time_stack:
+                self.compute_time_stack[-1] += elapsed
+            self.pop_result()
+            # this is actually referencing the parent uuid...
+            self.dataflow_state.set_cur_cell_id(self.parent_uuid())
+            # drop the edges recorded by a failed execution
+            self.dataflow_history_manager.end_journal(
+                rollback=result is None or not self.last_execution_succeeded)
         uuid = self.uuid
-        # this is actually referencing the parent uuid...
-        self.dataflow_state.set_cur_cell_id(self.parent_uuid())
 
         # AFTER RUN_AST_NODES CODE
         # # Reset this so later displayed values do not modify the
@@ -578,16 +879,11 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         # print("LAST EXECUTE SUCCEEDED?", self.last_execution_succeeded, self.uuid, uuid, file=sys.__stdout__)
 
         if not self.last_execution_succeeded:
-            for j in self.dataflow_history_manager.storeditems:
-                self.dataflow_history_manager.remove_dependencies(j['parent'],
-                                                                  j['child'])
             result.deleted_cells = result_deleted_cells
 
         if isinstance(result.result, LinkedResult):
             result.result.__sethist__(self.dataflow_history_manager)
 
-        self.dataflow_history_manager.storeditems = []
-
         if store_history:
             result.execution_count = int(uuid, 16)
 
@@ -598,7 +894,8 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
             if store_history:
                 # print("STORING HISTORY", cur_execution_count)
                 # print("STORING UPDATE VALUE:", uuid, result)
-                self.dataflow_history_manager.update_value(uuid, result.result)
+                self.dataflow_history_manager.update_value(uuid, result.result,
+                                                           compute_time)
                 self.dataflow_history_manager.set_not_stale(uuid)
 
             if store_history:
@@ -616,7 +913,8 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
                 result.links = self.dataflow_history_manager.raw_semantic_upstream(uuid)
                 result.deleted_cells = self.dataflow_history_manager.deleted_cells
 
-                result.internal_nodes = internalnodes
+                # set by run_ast_nodes from the tree it ran
+                result.internal_nodes = getattr(result, 'internal_nodes', [])
                 # print("GOT DELETED CELLS:", result.deleted_cells, file=sys.__stdout__)
                 self.dataflow_history_manager.deleted_cells = []
 
@@ -629,7 +927,10 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
                 result.all_downstream_deps = self.dataflow_history_manager.all_downstream(uuid)
 
             # run auto_updates
-            self.dataflow_history_manager.run_auto_updates(uuid)
+            skipped = self.dataflow_history_manager.run_auto_updates(uuid)
+            if skipped:
+                self.log.warning("Auto-update budget exhausted, left %d cells stale: %s",
+                                 len(skipped), ", ".join(skipped))
         return result
 
     # def run_cell(self, raw_cell, store_history=False, silent=False, shell_futures=True,
@@ -950,6 +1251,24 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         self.push_execution_count()
         self.push_uuid()
 
+        closure_key, closure_entry = self._closure_key, self._closure_entry
+        self._closure_key = self._closure_entry = None
+        if closure_entry is not None:
+            nodelist, interactivity, codes, internal_nodes = closure_entry
+            if result is not None:
+                result.internal_nodes = internal_nodes
+            res = await super().run_ast_nodes(nodelist, cell_name, interactivity,
+                                              ReplayCompiler(codes), result)
+            self.pop_uuid()
+            self.pop_execution_count()
+            return res
+
+        internal_nodes = [node.id for node in ast.walk(ast.Module(nodelist, []))
+                          if isinstance(node, ast.Name) and
+                          isinstance(node.ctx, ast.Store)]
+        if result is not None:
+            result.internal_nodes = internal_nodes
+
         no_link_vars = []
         auto_add_libs = True # FIXME add a configuration option that sets this
         # FIXME allow closure to be configurable?
@@ -1072,6 +1391,8 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
                     closure_expr = ast.Expr(ast.Await(ast.Call(ast.Name("__closure__", ast.Load()), [], [])))
                 else:
                     closure_expr = ast.Expr(ast.Call(ast.Name("__closure__", ast.Load()), [], []))
+                if self.hoist_references:
+                    nodelist = ReferenceHoister().hoist(nodelist)
                 nodelist = [ast.FunctionDef("__closure__",ast.arguments(posonlyargs=[],args=[],vararg=None,kwonlyargs=[],kw_defaults=[],kwarg=None,defaults=[]),nodelist,[],None),closure_expr]
                 if future_elt:
                     nodelist = future_elt + nodelist
@@ -1107,7 +1428,14 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         # mod = ast.Module(body=nodelist)
         # print(astor.to_source(mod))
         # print("END CODE")
+        if closure_key is not None:
+            compiler = RecordingCompiler(compiler)
+            cached_nodes = list(nodelist)
         res = await super().run_ast_nodes(nodelist, cell_name, interactivity, compiler, result)
+        if closure_key is not None and len(compiler.codes) == len(cached_nodes):
+            self.cache_put(self.closure_cache, closure_key,
+                           (cached_nodes, interactivity, compiler.codes,
+                            internal_nodes))
         # print("DONE WITH AST NODES")
         self.pop_uuid()
         self.pop_execution_count()
@@ -0,0 +1,400 @@
+"""Test suite for the dataflow history bookkeeping."""
+
+import logging
+import random
+from collections import OrderedDict
+from types import MethodType, SimpleNamespace
+
+import pytest
+from dfnbutils import (
+    convert_dollar,
+    convert_identifier,
+    dollar_replacer,
+    get_references,
+    ground_refs,
+    identifier_replacer,
+    ref_replacer,
+)
+
+from dfnotebook.kernel.dataflow import DataflowHistoryManager, DataflowState
+from dfnotebook.kernel.dfrewrite import rewrite_cell
+from dfnotebook.kernel.ipkernel import IPythonKernel
+from dfnotebook.kernel.spill import DataflowSpillStore
+
+
+def bfs(k, edges):
+    res = set()
+    frontier = list(edges[k])
+    while frontier:
+        cid = frontier.pop()
+        if cid not in res:
+            res.add(cid)
+            frontier.extend(edges[cid])
+    return res
+
+
+def test_reachability_index():
+    hist = DataflowHistoryManager(shell=None)
+    cells = [f"{i:08x}" for i in range(12)]
+    rng = random.Random(0)
+    for _ in range(300):
+        parent, child = sorted(rng.sample(range(len(cells)), 2))
+        if rng.random() < 0.6:
+            hist.update_dependencies(cells[parent], cells[child])
+        else:
+            hist.remove_dependencies(cells[parent], cells[child])
+        for cid in rng.sample(cells, 3):
+            assert set(hist.all_upstream(cid)) == bfs(cid, hist.dep_parents)
+            assert set(hist.all_downstream(cid)) == bfs(cid, hist.dep_children)
+
+
+def test_update_codes_batched_staleness():
+    shell = SimpleNamespace()
+    hist = DataflowHistoryManager(shell=shell)
+    shell.dataflow_state = DataflowState(hist)
+    hist.update_codes({"a": "x = 1", "b": "y = x", "c": "z = y", "d": "w = 2"})
+    for key in "abcd":
+        hist.update_value(key, None)
+        hist.set_not_stale(key)
+    hist.update_dependencies("a", "b")
+    hist.update_dependencies("b", "c")
+
+    assert hist.update_codes({"a": "x = 1", "b": "y = x", "c": "z = y", "d": "w = 2"}) == 0
+    assert not any(hist.is_stale(key) for key in "abcd")
+
+    assert hist.update_codes({"a": "x = 2", "b": "y = x", "c": "z = y"}) == 4
+    assert all(hist.is_stale(key) for key in "abcd")
+    assert hist.deleted_cells == ["d"]
+    assert "d" not in hist.code_cache
+
+
+def test_update_codes_partial():
+    shell = SimpleNamespace()
+    hist = DataflowHistoryManager(shell=shell)
+    shell.dataflow_state = DataflowState(hist)
+    hist.update_codes({"a": "x = 1", "b": "y = 2", "c": "z = 3"})
+    for key in "abc":
+        hist.update_value(key, None)
+        hist.set_not_stale(key)
+
+    assert hist.update_codes({"b": "y = 3"}, cell_ids=["a", "b"]) == 2
+    assert hist.code_cache == {"a": "x = 1", "b": "y = 3"}
+    assert not hist.is_stale("a")
+    assert hist.deleted_cells == ["c"]
+
+
+def test_value_cache_limit():
+    shell = SimpleNamespace(value_cache_limit=0)
+    hist = DataflowHistoryManager(shell=shell)
+    shell.dataflow_state = DataflowState(hist)
+    hist.update_codes({"a": "x", "b": "y", "c": "z", "d": "w"})
+    hist.update_force_cached({"a": True})
+    hist.update_value("a", bytearray(1000), 0.1)
+    hist.update_value("b", bytearray(1000), 10.0)
+    hist.update_value("c", bytearray(1000), 0.1)
+    assert set(hist.value_cache) == {"a", "b", "c"}
+
+    shell.value_cache_limit = 2500
+    hist.update_value("d", bytearray(100), 0.1)
+    # c is the cheapest to recompute, a is pinned
+    assert set(hist.value_cache) == {"a", "b", "d"}
+    assert "c" in hist.last_calculated
+
+
+def test_value_cache_spill(tmp_path):
+    shell = SimpleNamespace(value_cache_limit=0,
+                            value_cache_spill_dir=str(tmp_path))
+    hist = DataflowHistoryManager(shell=shell)
+    shell.dataflow_state = DataflowState(hist)
+    hist.update_codes({"a": "x", "b": "y"})
+    hist.update_value("a", bytearray(1000), 10.0)
+    hist.update_value("b", bytearray(100), 0.1)
+
+    shell.value_cache_limit = 1000
+    # the least recently calculated result is spilled, not the cheapest
+    assert hist.cull_cache() == ["a"]
+    assert "a" in hist.spill_store
+    assert hist.restore_value("a")
+    assert hist.value_cache["a"] == bytearray(1000)
+
+    hist.update_value("a", bytearray(10), 0.1)
+    assert "a" not in hist.spill_store
+
+
+def test_spill_load_workers(tmp_path):
+    shell = SimpleNamespace(value_cache_limit=10,
+                            value_cache_spill_dir=str(tmp_path),
+                            spill_load_workers=2)
+    hist = DataflowHistoryManager(shell=shell)
+    shell.dataflow_state = DataflowState(hist)
+    hist.update_codes({"a": "x", "b": "y", "c": "z"})
+    for key, size in [("a", 100), ("b", 200), ("c", 5)]:
+        hist.update_value(key, bytearray(size))
+    assert set(hist.value_cache) == {"c"}
+    hist.restore_values(["a", "b"])
+    assert hist.value_cache["a"] == bytearray(100)
+    assert hist.value_cache["b"] == bytearray(200)
+
+
+def test_value_cache_spill_memmap(tmp_path):
+    np = pytest.importorskip("numpy")
+    store = DataflowSpillStore(str(tmp_path))
+    store.store("a", np.arange(1000, dtype=np.float64))
+    arr = store.load("a")
+    assert not arr.flags.writeable
+    assert np.array_equal(arr, np.arange(1000, dtype=np.float64))
+
+
+def test_reuse_memoized():
+    shell = SimpleNamespace(memoize_results=True)
+    hist = DataflowHistoryManager(shell=shell)
+    shell.dataflow_state = DataflowState(hist)
+    hist.update_codes({"a": "x = 1", "b": "y = x + 1"})
+    hist.update_value("a", 1)
+    hist.set_not_stale("a")
+    hist.update_dependencies("a", "b")
+    hist.update_value("b", 2)
+    hist.set_not_stale("b")
+
+    hist.update_codes({"a": "x  =  1   # one", "b": "y = x + 1"})
+    assert hist.is_stale("a") and hist.is_stale("b")
+    assert hist.reuse_memoized("b")
+    assert not hist.is_stale("a") and not hist.is_stale("b")
+
+    hist.update_codes({"a": "x = 2", "b": "y = x + 1"})
+    assert not hist.reuse_memoized("a")
+    assert hist.is_stale("a")
+
+
+def test_memoize_off():
+    shell = SimpleNamespace(memoize_results=False)
+    hist = DataflowHistoryManager(shell=shell)
+    shell.dataflow_state = DataflowState(hist)
+    hist.update_codes({"a": "x = 1", "b": "y = x + 1"})
+    hist.update_value("a", 1)
+    hist.update_dependencies("a", "b")
+    hist.update_value("b", 2)
+    # no values are hashed when results are not reused
+    assert hist.memo_keys == {}
+    assert hist.value_fingerprints == {}
+    hist.update_codes({"a": "x = 1", "b": "y  =  x + 1"})
+    assert not hist.reuse_memoized("b")
+
+
+def test_stale_upstream_order():
+    shell = SimpleNamespace()
+    hist = DataflowHistoryManager(shell=shell)
+    shell.dataflow_state = DataflowState(hist)
+    hist.update_codes({key: key for key in "abcdef"})
+    for parent, child in ["ab", "ac", "bd", "cd", "de", "fe"]:
+        hist.update_dependencies(parent, child)
+    hist.set_not_stale("f")
+
+    order, inputs = hist.stale_upstream("e")
+    assert order == ["a", "b", "c", "d"]
+    assert inputs == {"f"}
+
+    hist.update_force_cached({"c": True})
+    hist.set_not_stale("a")
+    order, inputs = hist.stale_upstream("e")
+    assert order == ["b", "d"]
+    assert inputs == {"a", "c", "f"}
+
+
+def test_batch_order():
+    shell = SimpleNamespace()
+    hist = DataflowHistoryManager(shell=shell)
+    shell.dataflow_state = DataflowState(hist)
+    hist.update_codes({key: key for key in "abcdef"})
+    for parent, child in ["ab", "bc", "ad"]:
+        hist.update_dependencies(parent, child)
+    for key in "ad":
+        hist.set_not_stale(key)
+
+    # f and e have no known dependencies and keep the order given
+    order, inputs = hist.batch_order(["f", "c", "e"])
+    assert order == ["b", "f", "c", "e"]
+    assert inputs == {"a"}
+
+
+def test_run_auto_updates():
+    shell = SimpleNamespace(auto_update_max_cells=0)
+    hist = DataflowHistoryManager(shell=shell)
+    shell.dataflow_state = DataflowState(hist)
+    hist.update_codes({key: key for key in "abcdef"})
+    for parent, child in ["ab", "ac", "bd", "cd", "de", "af"]:
+        hist.update_dependencies(parent, child)
+    for key in "abcdef":
+        hist.set_not_stale(key)
+    hist.update_auto_update({"b": True, "c": True, "d": True, "e": True})
+    executed = []
+    hist.execute_cell = executed.append
+
+    assert hist.run_auto_updates("a") == []
+    assert executed == ["b", "c", "d", "e"]
+
+    executed.clear()
+    shell.auto_update_max_cells = 2
+    assert hist.run_auto_updates("a") == ["d", "e"]
+    assert executed == ["b", "c"]
+    assert hist.is_stale("d") and hist.is_stale("e")
+    assert not hist.is_stale("f")
+
+
+def test_dependency_journal():
+    hist = DataflowHistoryManager(shell=None)
+    hist.update_dependencies("a", "c")
+    hist.begin_journal()
+    for _ in range(1000):
+        hist.update_dependencies("a", "c")
+        hist.update_dependencies("b", "c")
+    hist.begin_journal()
+    hist.update_dependencies("a", "b")
+    hist.end_journal(rollback=False)
+    assert hist.journals == [{("b", "c"): None}]
+    hist.end_journal(rollback=True)
+    assert hist.dep_parents["c"] == {"a"}
+    assert hist.dep_parents["b"] == {"a"}
+
+
+def test_reference_memo():
+    shell = SimpleNamespace(uuid="b")
+    hist = DataflowHistoryManager(shell=shell)
+    shell.dataflow_state = DataflowState(hist)
+    hist.update_codes({"a": "x = 1", "b": "y = x"})
+    hist.update_value("a", 1)
+    hist.set_not_stale("a")
+    hist.begin_journal()
+    assert hist["a"] == 1
+    hist.remove_dependencies("a", "b")
+    # later accesses in the same execution skip the bookkeeping
+    assert hist["a"] == 1
+    assert hist.dep_parents["b"] == set()
+    hist.end_journal()
+    assert hist["a"] == 1
+    assert hist.dep_parents["b"] == {"a"}
+
+
+def test_rewrite_cell():
+    hist = DataflowHistoryManager(shell=None)
+    state = DataflowState(hist)
+    for name, cid in [("a", "aaaaaaaa"), ("b", "bbbbbbbb"), ("a", "dddddddd")]:
+        state.add_link(name, cid)
+    input_tags = {"tagb": "bbbbbbbb"}
+    output_tags = {"a": {"aaaaaaaa", "dddddddd"}, "b": {"bbbbbbbb"}}
+    code = "x = a$aaaaaaaa + b$tagb * a\ndef f(a):\n    return a + b$^ + a$^"
+
+    # same views as running the dfnbutils conversions one after another
+    parsed = convert_dollar(code, state, "ffffffff", identifier_replacer, input_tags)
+    grounded = ground_refs(parsed, state, "ffffffff", identifier_replacer,
+                           input_tags, output_tags=output_tags)
+    dollar_code = convert_identifier(grounded, dollar_replacer, input_tags=input_tags)
+    display_code = convert_identifier(
+        ground_refs(parsed, state, "ffffffff", identifier_replacer, input_tags,
+                    output_tags=output_tags, display_code=True),
+        dollar_replacer, input_tags=input_tags)
+
+    rewrite = rewrite_cell(code, state, "ffffffff", input_tags, output_tags)
+    assert rewrite.code == convert_dollar(dollar_code, state, "ffffffff",
+                                          ref_replacer, input_tags)
+    assert rewrite.dollar_code == dollar_code
+    assert rewrite.persistent_code == convert_identifier(
+        grounded, dollar_replacer, input_tags={})
+    assert rewrite.display_code == display_code
+    assert rewrite.identifier_refs == get_references(grounded)
+
+
+def test_dataflow_state_version():
+    state = DataflowState(DataflowHistoryManager(shell=None))
+    version = state.version
+    state.reset_cell("a")
+    assert state.version == version
+    state.add_link("x", "a")
+    assert state.version > version
+    version = state.version
+    state.add_link("y", "b")
+    state.reset_cell("a")
+    assert state.version > version
+    assert state.changed_links(version) == {"x", "y"}
+    assert state.changed_links(state.version) == set()
+
+    # adding back the same links, as every request and execution does
+    version = state.version
+    state.add_links({"b": ["y"]})
+    state.reset_cell("b")
+    state.add_link("y", "b")
+    assert state.version == version
+    assert state.changed_links(version) == set()
+
+
+def dataflow_kernel():
+    """The parts of an IPythonKernel the reference conversions use"""
+    shell = SimpleNamespace(conversion_cache=OrderedDict(),
+                            conversion_cache_size=256)
+    shell.dataflow_state = DataflowState(DataflowHistoryManager(shell=shell))
+    kernel = SimpleNamespace(shell=shell, log=logging.getLogger(__name__),
+                             _code_cells={}, _code_cells_tags=None)
+    for name in ("cached_conversion", "rewrite_cell", "code_cells_changes",
+                 "update_code_cells"):
+        setattr(kernel, name, MethodType(getattr(IPythonKernel, name), kernel))
+    return kernel
+
+
+def test_conversion_cache_across_requests():
+    kernel = dataflow_kernel()
+    state = kernel.shell.dataflow_state
+    state.add_link("x", "aaaaaaaa")
+    conversions = []
+
+    def convert():
+        conversions.append(1)
+        return "converted"
+
+    assert kernel.cached_conversion(convert, "x$aaaaaaaa", "bbbbbbbb") == "converted"
+    # the next request re-adds the links and runs the cell exporting x again
+    state.add_links({"aaaaaaaa": ["x"]})
+    state.reset_cell("aaaaaaaa")
+    state.add_link("x", "aaaaaaaa")
+    assert kernel.cached_conversion(convert, "x$aaaaaaaa", "bbbbbbbb") == "converted"
+    assert len(conversions) == 1
+
+    state.add_link("x", "cccccccc")
+    kernel.cached_conversion(convert, "x$aaaaaaaa", "bbbbbbbb")
+    assert len(conversions) == 2
+
+
+def test_update_code_cells_unchanged_links():
+    kernel = dataflow_kernel()
+    state = kernel.shell.dataflow_state
+    state.add_link("x", "aaaaaaaa")
+    conversions = []
+    cached_conversion = kernel.cached_conversion
+
+    def counted_conversion(func, code, uuid, *args):
+        conversions.append(uuid)
+        return cached_conversion(func, code, uuid, *args)
+
+    kernel.cached_conversion = counted_conversion
+    dfmetadata = {
+        "code_dict": {"aaaaaaaa": "x = 1", "bbbbbbbb": "y = x$aaaaaaaa + 1"},
+        "all_refs": {
+            "aaaaaaaa": {"ref": {}, "tag_refs": {}},
+            "bbbbbbbb": {"ref": {"aaaaaaaa": ["x"]}, "tag_refs": {}},
+        },
+        "output_tags": {"aaaaaaaa": ["x"], "bbbbbbbb": ["y"]},
+        "input_tags": {},
+        "executed_code": {},
+    }
+    kernel.update_code_cells(dfmetadata)
+    assert sorted(conversions) == ["aaaaaaaa", "bbbbbbbb"]
+
+    # the next request re-runs aaaaaaaa, which exports the same x
+    del conversions[:]
+    state.reset_cell("aaaaaaaa")
+    state.add_link("x", "aaaaaaaa")
+    kernel.update_code_cells(dfmetadata)
+    assert conversions == []
+
+    state.add_link("x", "cccccccc")
+    kernel.update_code_cells(dfmetadata)
+    assert conversions == ["bbbbbbbb"]
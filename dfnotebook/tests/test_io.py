@@ -66,6 +66,25 @@ def test_io_isatty(iopub_thread):
     assert stream.isatty()
 
 
+def test_io_uuid_buffers(iopub_thread):
+    session = Session()
+    stream = OutStream(session, iopub_thread, "stdout")
+    stream.flush_interval = 10
+    uuid = [1]
+    stream.get_execution_count = lambda: uuid[0]
+    for count, text in [(1, "a"), (2, "b"), (1, "c")]:
+        uuid[0] = count
+        stream.write(text)
+    uuid[0] = 3
+
+    # text keeps the cell that wrote it, not the one current at flush time
+    flushed = [
+        (stream.uuid_hook({"content": {}})["content"]["execution_count"], data)
+        for _, data in stream._flush_buffers()
+    ]
+    assert flushed == [(1, "ac"), (2, "b")]
+
+
 async def test_io_thread(anyio_backend, iopub_thread):
     thread = iopub_thread
     thread._setup_pipe_in()
@@ -24,10 +24,13 @@ from .utils import (
     TIMEOUT,
     assemble_output,
     execute,
+    execute_dataflow,
     flush_channels,
     get_reply,
     kernel,
+    new_dfkernel,
     new_kernel,
+    send_dataflow,
     wait_for_idle,
 )
 
@@ -716,3 +719,217 @@ def test_shutdown_subprocesses():
             child_newpg.terminate()
         except psutil.NoSuchProcess:
             pass
+
+
+# dataflow tests
+
+
+def test_dataflow_batch_identical_cells():
+    """cells with the same source in one batch each get their own tree"""
+    code_dict = {
+        "aaaaaaaa": "x = 1",
+        "bbbbbbbb": "x$aaaaaaaa + 1",
+        "cccccccc": "x$aaaaaaaa + 1",
+    }
+    with new_dfkernel() as kc:
+        execute_dataflow(kc, "aaaaaaaa", code_dict)
+        replies, _ = execute_dataflow(
+            kc, "bbbbbbbb", code_dict, batch=["bbbbbbbb", "cccccccc"]
+        )
+        reply = replies[-1]
+        assert reply["status"] == "ok", reply.get("evalue")
+        assert {cid: entry["status"] for cid, entry in reply["batch"].items()} == {
+            "bbbbbbbb": "ok",
+            "cccccccc": "ok",
+        }
+
+
+def _send_dfcode(kc, msg_type, content):
+    """Send a dfcode comm message, returning its iopub comm messages"""
+    msg = kc.session.msg(msg_type, content)
+    kc.shell_channel.send(msg)
+    msgs = []
+    while True:
+        reply = kc.get_iopub_msg(timeout=TIMEOUT)
+        if reply["parent_header"].get("msg_id") != msg["header"]["msg_id"]:
+            continue
+        if reply["msg_type"] == "status" and reply["content"]["execution_state"] == "idle":
+            return msgs
+        if reply["msg_type"].startswith("comm_"):
+            msgs.append(reply)
+
+
+def test_dataflow_persistent_dfcode_comm():
+    """a persistent dfcode comm answers every request with its request_id"""
+    dfmetadata = {
+        "code_dict": {"aaaaaaaa": "x = 1"},
+        "all_refs": {"aaaaaaaa": {"ref": {}, "tag_refs": {}}},
+        "output_tags": {"aaaaaaaa": ["x"]},
+        "input_tags": {},
+        "executed_code": {},
+    }
+    comm_id = "dfcode-test"
+    with new_dfkernel() as kc:
+        msgs = _send_dfcode(
+            kc,
+            "comm_open",
+            {"comm_id": comm_id, "target_name": "dfcode", "data": {"persistent": True}},
+        )
+        assert msgs == []
+        for request_id in (1, 2):
+            msgs = _send_dfcode(
+                kc,
+                "comm_msg",
+                {
+                    "comm_id": comm_id,
+                    "data": {"dfMetadata": dfmetadata, "request_id": request_id},
+                },
+            )
+            assert [msg["msg_type"] for msg in msgs] == ["comm_msg"]
+            data = msgs[0]["content"]["data"]
+            assert data["request_id"] == request_id
+            assert data["code_dict"] == {}
+
+        # without persistent the comm is closed after the first answer
+        _send_dfcode(kc, "comm_open", {"comm_id": "dfcode-once", "target_name": "dfcode", "data": {}})
+        msgs = _send_dfcode(
+            kc, "comm_msg", {"comm_id": "dfcode-once", "data": {"dfMetadata": dfmetadata}}
+        )
+        assert [msg["msg_type"] for msg in msgs] == ["comm_msg", "comm_close"]
+        assert "request_id" not in msgs[0]["content"]["data"]
+
+
+def _execute_result(iopub):
+    return [
+        msg["content"]["data"]["text/plain"]
+        for msg in iopub
+        if msg["msg_type"] == "execute_result"
+    ]
+
+
+def test_dataflow_code_dict_resync():
+    """a code_dict delta against an unknown version asks for the full dict"""
+    code_dict = {"aaaaaaaa": "x = 1", "bbbbbbbb": "x$aaaaaaaa + 1"}
+    cell_ids = list(code_dict)
+    with new_dfkernel() as kc:
+        replies, iopub = execute_dataflow(
+            kc, "aaaaaaaa", {"aaaaaaaa": "x = 1"}, cell_ids=cell_ids,
+            code_dict_mode="delta", code_dict_base_version=1, code_dict_version=2,
+        )
+        assert len(replies) == 1
+        assert replies[0]["status"] == "aborted"
+        assert replies[0]["code_dict_resync"]
+        assert replies[0]["execution_count"] == int("aaaaaaaa", 16)
+        assert _execute_result(iopub) == []
+
+        # the frontend resends the full code_dict
+        replies, _ = execute_dataflow(
+            kc, "aaaaaaaa", code_dict, cell_ids=cell_ids, code_dict_version=2
+        )
+        assert replies[-1]["status"] == "ok"
+        assert replies[-1]["code_dict_version"] == 2
+        # later deltas against that version are applied
+        replies, iopub = execute_dataflow(
+            kc, "bbbbbbbb", {"bbbbbbbb": "x$aaaaaaaa + 1"}, cell_ids=cell_ids,
+            code_dict_mode="delta", code_dict_base_version=2, code_dict_version=3,
+        )
+        assert replies[-1]["status"] == "ok", replies[-1].get("evalue")
+        assert "code_dict_resync" not in replies[-1]
+        assert replies[-1]["code_dict_version"] == 3
+        assert _execute_result(iopub) == ["2"]
+
+
+def test_dataflow_run_upstream():
+    """stale upstream cells run first, each with its own reply"""
+    code_dict = {
+        "aaaaaaaa": "x = 1",
+        "bbbbbbbb": "y = x$aaaaaaaa + 1",
+        "cccccccc": "y$bbbbbbbb * 10",
+    }
+    with new_dfkernel() as kc:
+        for uuid in code_dict:
+            execute_dataflow(kc, uuid, code_dict)
+        code_dict["aaaaaaaa"] = "x = 2"
+        replies, iopub = execute_dataflow(kc, "cccccccc", code_dict)
+        assert [reply["status"] for reply in replies] == ["ok", "ok", "ok"]
+        assert [reply["execution_count"] for reply in replies] == [
+            int(uuid, 16) for uuid in code_dict
+        ]
+        assert _execute_result(iopub) == ["2", "3", "30"]
+
+
+def test_dataflow_run_upstream_error():
+    """a failing upstream cell fails the request and aborts queued ones"""
+    code_dict = {"aaaaaaaa": "x = 1", "bbbbbbbb": "x$aaaaaaaa + 1"}
+    with new_dfkernel() as kc:
+        for uuid in code_dict:
+            execute_dataflow(kc, uuid, code_dict)
+        code_dict["aaaaaaaa"] = "x = 1 / 0"
+        msg_id = send_dataflow(kc, "bbbbbbbb", code_dict)
+        queued_id = send_dataflow(kc, "bbbbbbbb", code_dict)
+        replies = {}
+        while len(replies.get(queued_id, [])) < 1:
+            reply = kc.get_shell_msg(timeout=TIMEOUT)
+            replies.setdefault(reply["parent_header"]["msg_id"], []).append(
+                reply["content"]
+            )
+        upstream, cell = replies[msg_id]
+        assert upstream["status"] == "error"
+        assert upstream["ename"] == "ZeroDivisionError"
+        assert upstream["execution_count"] == int("aaaaaaaa", 16)
+        assert cell["status"] == "error"
+        assert replies[queued_id][0]["status"] == "aborted"
+
+
+def test_dataflow_closure_cache():
+    """re-running a cell reuses its compiled closure with new upstream values"""
+    find_entry = "[v for k, v in get_ipython().closure_cache.items() if k[1] == 'bbbbbbbb'][0]"
+    code_dict = {
+        "aaaaaaaa": "x = 1",
+        "bbbbbbbb": "x$aaaaaaaa + 1",
+        "cccccccc": "entry = " + find_entry,
+        "dddddddd": find_entry + " is entry$cccccccc",
+    }
+    with new_dfkernel() as kc:
+        execute_dataflow(kc, "aaaaaaaa", code_dict)
+        _, iopub = execute_dataflow(kc, "bbbbbbbb", code_dict)
+        assert _execute_result(iopub) == ["2"]
+        execute_dataflow(kc, "cccccccc", code_dict)
+        code_dict["aaaaaaaa"] = "x = 5"
+        _, iopub = execute_dataflow(kc, "bbbbbbbb", code_dict)
+        assert _execute_result(iopub) == ["5", "6"]
+        _, iopub = execute_dataflow(kc, "dddddddd", code_dict)
+        assert _execute_result(iopub) == ["True"]
+
+
+def test_dataflow_graph_delta():
+    """replies to a delta request only carry what changed in the graph"""
+    code_dict = {"aaaaaaaa": "x = 1", "bbbbbbbb": "y = x$aaaaaaaa + 1"}
+    with new_dfkernel() as kc:
+        replies, _ = execute_dataflow(kc, "aaaaaaaa", code_dict, reply_mode="delta")
+        full = replies[-1]
+        assert "graph_delta" not in full
+        assert full["cells"] == ["aaaaaaaa"]
+        assert "update_downstreams" in full
+
+        replies, _ = execute_dataflow(
+            kc, "bbbbbbbb", code_dict, reply_mode="delta",
+            graph_version=full["graph_version"],
+        )
+        delta = replies[-1]
+        assert delta["graph_delta"]
+        assert delta["graph_version"] == full["graph_version"] + 1
+        assert "cells" not in delta and "update_downstreams" not in delta
+        assert delta["cells_delta"] == {"removed": [], "appended": ["bbbbbbbb"]}
+        assert "aaaaaaaa" in delta["downstream_keys"]
+        assert {"key": "aaaaaaaa", "added": ["bbbbbbbb"], "removed": []} in delta[
+            "downstream_delta"
+        ]
+
+        # a stale graph_version gets the full graph again
+        replies, _ = execute_dataflow(
+            kc, "bbbbbbbb", code_dict, reply_mode="delta",
+            graph_version=full["graph_version"],
+        )
+        assert "graph_delta" not in replies[-1]
+        assert replies[-1]["cells"] == ["aaaaaaaa", "bbbbbbbb"]
@@ -3,6 +3,8 @@
 # Copyright (c) IPython Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+import ast
+import asyncio
 import os
 import unittest
 import warnings
@@ -15,9 +17,12 @@ import zmq
 from jupyter_client.session import Session
 from traitlets import Int
 
+from dfnotebook.kernel.displayhook import ZMQShellDisplayHook
 from dfnotebook.kernel.zmqshell import (  # type:ignore
+    DataflowCachingCompiler,
     InteractiveShell,
     KernelMagics,
+    ReferenceHoister,
     ZMQDisplayPublisher,
     ZMQInteractiveShell,
 )
@@ -253,5 +258,168 @@ def test_zmq_interactive_shell(kernel):
     shell.ask_exit()
 
 
+def test_reference_hoister():
+    src = (
+        "x = _oh['aaaaaaaa']['a'] * 2\n"
+        "for i in range(3):\n"
+        "    y = _oh['aaaaaaaa']['a'] + _oh['bbbbbbbb']['b']\n"
+        "def f():\n"
+        "    return _oh['cccccccc']['c']\n"
+    )
+    body = ReferenceHoister().hoist(ast.parse(src).body)
+    out = ast.unparse(ast.fix_missing_locations(ast.Module(body, [])))
+    assert out.splitlines()[:3] == [
+        "__dfref0__ = _oh['aaaaaaaa']['a']",
+        "__dfref1__ = None",
+        "x = __dfref0__ * 2",
+    ]
+    assert "(__dfref1__ := _oh['bbbbbbbb']['b'])" in out
+    assert "return _oh['cccccccc']['c']" in out
+
+
+def test_reference_hoister_short_circuit():
+    # no upstream values, so a reference that is looked up raises
+    for src, result in [
+        ("assert True, _oh['aaaaaaaa']['x']\nr = 1", 1),
+        ("r = 0 > 1 > _oh['aaaaaaaa']['x']", False),
+        ("r = False and _oh['aaaaaaaa']['x']", False),
+    ]:
+        body = ReferenceHoister().hoist(ast.parse(src).body)
+        ns = {"_oh": {}}
+        exec(compile(ast.fix_missing_locations(ast.Module(body, [])), "<test>", "exec"), ns)
+        assert ns["r"] == result, src
+
+
+def test_skip_parse():
+    compiler = DataflowCachingCompiler()
+    compiler.skip_parse = True
+    # the cached closure is replayed, so only the next parse is skipped
+    assert compiler.ast_parse("x = 1").body == []
+    assert not compiler.skip_parse
+    tree = compiler.ast_parse("x = 1")
+    tree.body.clear()
+    assert len(compiler.ast_parse("x = 1").body) == 1
+
+
+def test_cancelled_cell_pops_stacks():
+    shell = ZMQInteractiveShell(compiler_class=DataflowCachingCompiler)
+    hist = shell.dataflow_history_manager
+
+    async def cancelled(*args, **kwargs):
+        raise asyncio.CancelledError
+
+    shell.run_ast_nodes = cancelled
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(shell.run_cell_async_override(
+            "x = 1", store_history=True, uuid="aaaaaaaa",
+            dfkernel_data={"code_dict": {"aaaaaaaa": "x = 1"}},
+            transformed_cell="x = 1\n"))
+    assert hist.journals == [] and hist.ref_memos == []
+    # later cells look references up again instead of using its memo
+    assert hist.ref_memo() is None
+    assert shell.compute_time_stack == [] and shell.result_stack == []
+    assert not shell.compile.skip_parse
+
+
+def test_batched_outputs():
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    session = CounterSession()
+    hook = ZMQShellDisplayHook(shell=InteractiveShell(), session=session,
+                               pub_socket=socket)
+
+    def finish(batch_outputs):
+        hook.batch_outputs = batch_outputs
+        hook.msg = session.msg("execute_result", {
+            "execution_count": 1,
+            "data": {0: {"text/plain": "1"}, 1: {"text/plain": "2"}},
+            "metadata": {0: {"output_tag": "a"}, 1: {"output_tag": "b"}},
+        })
+        hook.finish_displayhook()
+
+    finish(False)
+    assert session.send_count == 2
+    finish(True)
+    assert session.send_count == 3
+
+    socket.close()
+    context.destroy()
+
+
+def test_deferred_outputs():
+    shell = ZMQInteractiveShell()
+    shell.uuid = "aaaaaaaa"
+    shell.output_size_limit = 1000
+    shell.output_preview_length = 20
+    hook = shell.displayhook
+
+    hist = shell.dataflow_history_manager
+    value = list(range(1000))
+    format_dicts, md_dicts = hook.compute_format_data(value)
+    assert md_dicts[0]["deferred"]
+    assert format_dicts[0] == {"text/plain": "[0, 1, 2, 3, 4, 5, ...]"}
+    # only the tag is kept, the value comes from the history manager
+    assert hook.deferred_outputs == {"aaaaaaaa": {None}}
+    hist.update_value("aaaaaaaa", value)
+    format_dict, md_dict = hook.render_deferred("aaaaaaaa", None)
+    assert format_dict["text/plain"].count(",") == 999
+    # a result that is no longer cached cannot be rendered
+    del hist.value_cache["aaaaaaaa"]
+    with pytest.raises(KeyError):
+        hook.render_deferred("aaaaaaaa", None)
+
+    format_dicts, md_dicts = hook.compute_format_data(list(range(10)))
+    assert "deferred" not in md_dicts[0]
+    with pytest.raises(KeyError):
+        hook.render_deferred("aaaaaaaa", None)
+
+
+def test_unchanged_outputs():
+    shell = ZMQInteractiveShell()
+    shell.uuid = "aaaaaaaa"
+    hook = shell.displayhook
+    hook.dedup_outputs = True
+
+    def write(format_dicts, md_dicts):
+        hook.msg = {"content": {}}
+        hook.write_format_data(format_dicts, md_dicts)
+        return hook.msg["content"]["data"], hook.msg["content"]["metadata"]
+
+    data, metadata = write({0: {"text/plain": "1"}, 1: {"text/plain": "2"}},
+                           {0: {"output_tag": "a"}, 1: {"output_tag": "b"}})
+    assert data == {0: {"text/plain": "1"}, 1: {"text/plain": "2"}}
+    hook.output_digests = {"aaaaaaaa": {"a": metadata[0]["output_digest"],
+                                        "b": metadata[1]["output_digest"]}}
+
+    data, metadata = write({0: {"text/plain": "1"}, 1: {"text/plain": "3"}},
+                           {0: {"output_tag": "a"}, 1: {"output_tag": "b"}})
+    assert data[0] == {}
+    assert metadata[0] == {"unchanged": True, "output_tag": "a"}
+    assert data[1] == {"text/plain": "3"}
+
+
+def test_binary_outputs():
+    sent = []
+
+    class RecordingSession(Session):
+        def send(self, stream, msg_or_type, *args, buffers=None, **kwargs):
+            sent.append((msg_or_type["content"].copy(), buffers))
+
+    shell = ZMQInteractiveShell()
+    shell.uuid = "aaaaaaaa"
+    hook = ZMQShellDisplayHook(shell=shell, session=RecordingSession())
+    hook.binary_outputs = True
+    hook.msg = {"content": {}}
+    png = b"\x89PNG\r\n\x1a\n"
+    hook.write_format_data({0: {"text/plain": "<Figure>", "image/png": png}},
+                           {0: {}})
+    hook.finish_displayhook()
+
+    content, buffers = sent[0]
+    assert content["data"] == {"text/plain": "<Figure>"}
+    assert content["buffer_paths"] == [["data", "image/png"]]
+    assert buffers == [png]
+
+
 if __name__ == "__main__":
     unittest.main()
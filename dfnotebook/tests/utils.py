@@ -184,6 +184,93 @@ def new_kernel(argv=None):
     return manager.run_kernel(**kwargs)
 
 
+@contextmanager
+def new_dfkernel(argv=None):
+    """Context manager for a new dataflow kernel in a subprocess
+
+    Returns
+    -------
+    kernel_client: connected KernelClient instance
+    """
+    from jupyter_client.kernelspec import KernelSpecManager
+
+    from dfnotebook.kernel.kernelspec import (
+        KERNEL_NAME,
+        make_ipkernel_cmd,
+        write_kernel_spec,
+    )
+
+    with TemporaryDirectory() as kernel_dir:
+        write_kernel_spec(
+            os.path.join(kernel_dir, KERNEL_NAME),
+            overrides={"argv": make_ipkernel_cmd("dfnotebook.kernel", extra_arguments=argv)},
+        )
+        km = manager.KernelManager(
+            kernel_name=KERNEL_NAME,
+            kernel_spec_manager=KernelSpecManager(kernel_dirs=[kernel_dir]),
+        )
+        km.start_kernel(stderr=STDOUT)
+        kc = km.client()
+        kc.start_channels()
+        kc.wait_for_ready(timeout=STARTUP_TIMEOUT)
+        try:
+            yield kc
+        finally:
+            kc.stop_channels()
+            km.shutdown_kernel(now=True)
+
+
+def send_dataflow(kc, uuid, code_dict, stop_on_error=True, **dfkernel_data):
+    """Send an execute_request for cell uuid of code_dict, returning its msg_id"""
+    dfkernel_data = {
+        "uuid": uuid,
+        "code_dict": dict(code_dict),
+        "output_tags": {},
+        "input_tags": {},
+        "auto_update_flags": {},
+        "force_cached_flags": {},
+        **dfkernel_data,
+    }
+    # kc.execute only accepts string user_expressions
+    content = dict(
+        code=code_dict.get(uuid, ""),
+        silent=False,
+        store_history=True,
+        user_expressions={"__dfkernel_data__": dfkernel_data},
+        allow_stdin=False,
+        stop_on_error=stop_on_error,
+    )
+    msg = kc.session.msg("execute_request", content)
+    kc.shell_channel.send(msg)
+    return msg["header"]["msg_id"]
+
+
+def execute_dataflow(kc, uuid, code_dict, stop_on_error=True, timeout=TIMEOUT, **dfkernel_data):
+    """Execute cell uuid of code_dict like the notebook frontend does
+
+    Returns the execute_reply contents sent for the request, the last one
+    being the reply for the cell itself, and its iopub messages.
+    """
+    msg_id = send_dataflow(kc, uuid, code_dict, stop_on_error, **dfkernel_data)
+    iopub = []
+    while True:
+        msg = kc.get_iopub_msg(timeout=timeout)
+        if msg["parent_header"].get("msg_id") != msg_id:
+            continue
+        if msg["msg_type"] == "status" and msg["content"]["execution_state"] == "idle":
+            break
+        iopub.append(msg)
+    replies = []
+    while True:
+        try:
+            reply = kc.get_shell_msg(timeout=0.5)
+        except Empty:
+            break
+        if reply["parent_header"].get("msg_id") == msg_id:
+            replies.append(reply["content"])
+    return replies, iopub
+
+
 def assemble_output(get_msg):
     """assemble stdout/err from an execution"""
     stdout = ""
@@ -266,7 +266,8 @@ export namespace DataflowCodeCell {
     sessionContext: ISessionContext,
     metadata?: JSONObject,
     dfData?: JSONObject,
-    cellIdModelMap?: { [key: string]: ICodeCellModel }
+    cellIdModelMap?: { [key: string]: ICodeCellModel },
+    cellContents?: { [key: string]: string }
   ): Promise<KernelMessage.IExecuteReplyMsg | void> {
     const model = cell.model;
     const code = model.sharedModel.getSource();
@@ -283,6 +284,12 @@ export namespace DataflowCodeCell {
       ...cellId
     };
     const { recordTiming } = metadata;
+    const outputDigests = DataflowOutputArea.outputDigests(
+      Object.fromEntries(
+        Object.entries(cellIdModelMap ?? {}).map(([id, m]) => [id, m.outputs])
+      )
+    );
+    DataflowOutputArea.stashOutputs(truncateCellId(model.id), model.outputs);
     model.sharedModel.transact(() => {
       model.clearExecution();
       cell.outputHidden = false;
@@ -303,6 +310,25 @@ export namespace DataflowCodeCell {
         }
       }
       
+      // ask for graph changes since the last reply this graph applied, for
+      // the outputs of each cell in a single message with binary data in
+      // buffers, and to only mark the outputs the cells already show as
+      // unchanged
+      const graphVersion = GraphManager.graphs[sessionContext.session.id]?.graphVersion;
+      if (dfData) {
+        dfData = {
+          ...dfData,
+          reply_mode: 'delta',
+          batch_outputs: true,
+          dedup_outputs: true,
+          binary_outputs: true,
+          output_digests: outputDigests
+        };
+        if (graphVersion !== undefined) {
+          dfData.graph_version = graphVersion;
+        }
+      }
+
       const msgPromise = DataflowOutputArea.execute(
         code,
         cell.outputArea,
@@ -356,6 +382,7 @@ export namespace DataflowCodeCell {
                 cellModel.sharedModel.setSource(
                   (msg as KernelMessage.IExecuteInputMsg).content.code
                 );
+                DataflowOutputArea.stashOutputs(cellId, cellModel.outputs);
                 cellModel.outputs.clear();
               }
             }
@@ -389,12 +416,10 @@ export namespace DataflowCodeCell {
       }
 
       let content = (msg.content as any);
-      let nodes = content.nodes;
-      let uplinks = content.links;
-      let cells = content.cells;
-      let downlinks = content.imm_downstream_deps;
-      let allUps = content.upstream_deps;
-      let internalNodes = content.internal_nodes;
+      if (content.code_dict_resync) {
+        // nothing ran, the caller resends with the full code_dict
+        return msg;
+      }
       let sessId = sessionContext.session.id;
       let graphUndefined = false;
       
@@ -403,7 +428,14 @@ export namespace DataflowCodeCell {
         GraphManager.createGraph(sessId);
         graphUndefined = true;
       }
-      GraphManager.graphs[sessId].updateCellContents(dfData?.code_dict);
+      GraphManager.graphs[sessId].expandReply(content);
+      let nodes = content.nodes;
+      let uplinks = content.links;
+      let cells = content.cells;
+      let downlinks = content.imm_downstream_deps;
+      let allUps = content.upstream_deps;
+      let internalNodes = content.internal_nodes;
+      GraphManager.graphs[sessId].updateCellContents(cellContents ?? dfData?.code_dict);
       GraphManager.graphs[sessId].updateGraph(cells,nodes,uplinks,downlinks,`${cell.model.id.substr(0, 8) || ''}`,allUps,internalNodes);
       if (!graphUndefined){
         GraphManager.updateDepViews(false);
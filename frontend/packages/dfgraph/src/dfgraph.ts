@@ -184,6 +184,10 @@ export class Graph {
   cellOrder: any;
   states: any;
   executed: any;
+  // graph data as of the last execute_reply, used to expand deltas
+  graphVersion: number | undefined;
+  replyCells: string[];
+  replyDownstreams: { [key: string]: string[] };
 
   /*
    * Create a graph to contain all inner cell dependencies
@@ -222,6 +226,9 @@ export class Graph {
     this.upstreamList = {};
     this.states = states || {};
     this.executed = {};
+    this.graphVersion = undefined;
+    this.replyCells = [];
+    this.replyDownstreams = {};
     if (that.cells.length > 1) {
       that.cells.forEach(function (uuid: string) {
         that.states[uuid] = 'Stale';
@@ -289,6 +296,41 @@ export class Graph {
     }, true);
   }
 
+  /** @method expandReply fills in cells and update_downstreams of a delta-encoded execute_reply */
+  expandReply(this: Graph, content: any) {
+    let that: Graph = this;
+    if (content.graph_version === undefined) {
+      return;
+    }
+    if (!content.graph_delta) {
+      that.replyDownstreams = {};
+      (content.update_downstreams || []).forEach(function (t: any) {
+        that.replyDownstreams[t.key] = t.data;
+      });
+    } else {
+      if (content.cells_delta) {
+        let moved = new Set([
+          ...content.cells_delta.removed,
+          ...content.cells_delta.appended
+        ]);
+        content.cells = that.replyCells
+          .filter((cid: string) => !moved.has(cid))
+          .concat(content.cells_delta.appended);
+      }
+      content.downstream_delta.forEach(function (t: any) {
+        let removed = new Set(t.removed);
+        that.replyDownstreams[t.key] = (that.replyDownstreams[t.key] || [])
+          .filter((cid: string) => !removed.has(cid))
+          .concat(t.added);
+      });
+      content.update_downstreams = content.downstream_keys.map(function (key: string) {
+        return { key: key, data: that.replyDownstreams[key] || [] };
+      });
+    }
+    that.replyCells = content.cells;
+    that.graphVersion = content.graph_version;
+  }
+
   /** @method updateGraph */
   updateGraph(
     this: Graph,
@@ -5,7 +5,7 @@ import {
   type ICodeCellModel,
   type MarkdownCell
 } from '@jupyterlab/cells';
-import type { KernelMessage } from '@jupyterlab/services';
+import type { Kernel, KernelMessage } from '@jupyterlab/services';
 import { nullTranslator } from '@jupyterlab/translation';
 import { findIndex } from '@lumino/algorithm';
 import { KernelError, INotebookModel, INotebookCellExecutor } from '@jupyterlab/notebook';
@@ -92,16 +92,23 @@ import { truncateCellId } from '@dfnotebook/dfutils';
                 dfData.dfMetadata.input_tags={};
               }
 
-              reply = await DataflowCodeCell.execute(
+              const executeCell = () => DataflowCodeCell.execute(
                   cell as DataflowCodeCell,
                   sessionContext,
                   {
                   deletedCells,
                   recordTiming: notebookConfig.recordTiming
                   },
-                  dfData.dfMetadata,
-                  dfData.cellIdModelMap
+                  encodeCodeDict(notebookId, dfData.dfMetadata),
+                  dfData.cellIdModelMap,
+                  dfData.dfMetadata.code_dict
               );
+              reply = await executeCell();
+              if ((reply?.content as any)?.code_dict_resync) {
+                // kernel lost track of our code_dict (e.g. restarted), send all of it
+                resetCodeDict(notebookId);
+                reply = await executeCell();
+              }
               
               resetCellPrompt(notebook, cell)
               
@@ -183,7 +190,7 @@ import { truncateCellId } from '@dfnotebook/dfutils';
       dfData.dfMetadata.input_tags = {};
     }
     try {
-      const response = await dfCommGetData(sessionContext, {'dfMetadata': dfData.dfMetadata});
+      const response = await dfCommGetData(sessionContext, {'dfMetadata': dfData.dfMetadata}, true);
       if (response?.code_dict && Object.keys(response.code_dict).length > 0) {
         await updateNotebookCells(notebook, notebookId, response.code_dict);
       }
@@ -192,19 +199,112 @@ import { truncateCellId } from '@dfnotebook/dfutils';
     }
   }
 
-  export async function dfCommGetData(sessionContext: ISessionContext, commData: any): Promise<any> {
-    return new Promise<void>((resolve) => {
-      const comm = sessionContext.session?.kernel?.createComm('dfcode');
-      if (!comm) {
-        resolve();
+  interface IDfCodeRequest {
+    data: any;
+    resolvers: ((content: any) => void)[];
+    coalesced: boolean;
+  }
+
+  /**
+   * A dfcode comm kept open for the lifetime of a kernel connection.
+   * Requests carry a request_id that the kernel echoes in its reply.
+   */
+  interface IDfCodeChannel {
+    comm: Kernel.IComm;
+    nextId: number;
+    pending: Map<number, IDfCodeRequest>;
+    // coalesced request waiting for the one in flight
+    queued: IDfCodeRequest | null;
+    inFlight: boolean;
+  }
+
+  const dfCodeChannels = new WeakMap<Kernel.IKernelConnection, IDfCodeChannel>();
+
+  function closeDfCodeChannel(kernel: Kernel.IKernelConnection, channel: IDfCodeChannel) {
+    if (dfCodeChannels.get(kernel) === channel) {
+      dfCodeChannels.delete(kernel);
+    }
+    const requests = Array.from(channel.pending.values());
+    if (channel.queued) {
+      requests.push(channel.queued);
+    }
+    channel.pending.clear();
+    channel.queued = null;
+    requests.forEach(request => request.resolvers.forEach(resolve => resolve(undefined)));
+  }
+
+  function sendDfCodeRequest(channel: IDfCodeChannel, request: IDfCodeRequest) {
+    const requestId = channel.nextId++;
+    channel.pending.set(requestId, request);
+    if (request.coalesced) {
+      channel.inFlight = true;
+    }
+    channel.comm.send({ ...request.data, request_id: requestId });
+  }
+
+  function getDfCodeChannel(kernel: Kernel.IKernelConnection): IDfCodeChannel {
+    const existing = dfCodeChannels.get(kernel);
+    if (existing && !existing.comm.isDisposed) {
+      return existing;
+    }
+    if (existing) {
+      // comms are disposed when the kernel restarts
+      closeDfCodeChannel(kernel, existing);
+    }
+    const channel: IDfCodeChannel = {
+      comm: kernel.createComm('dfcode'),
+      nextId: 0,
+      pending: new Map(),
+      queued: null,
+      inFlight: false
+    };
+    channel.comm.onMsg = (msg: any) => {
+      const content = msg.content.data;
+      const request = channel.pending.get(content.request_id);
+      if (!request) {
         return;
       }
-      comm.open();
-      comm.send(commData);
-      comm.onMsg = (msg: any) => {
-        const content = msg.content.data;
-        resolve(content);
-      };
+      channel.pending.delete(content.request_id);
+      request.resolvers.forEach(resolve => resolve(content));
+      if (request.coalesced) {
+        channel.inFlight = false;
+        const queued = channel.queued;
+        channel.queued = null;
+        if (queued) {
+          sendDfCodeRequest(channel, queued);
+        }
+      }
+    };
+    channel.comm.onClose = () => closeDfCodeChannel(kernel, channel);
+    channel.comm.open({ persistent: true });
+    dfCodeChannels.set(kernel, channel);
+    return channel;
+  }
+
+  /**
+   * Send a request over the kernel's dfcode comm and wait for its reply.
+   *
+   * With coalesce set, a request made while another coalesced request is in
+   * flight waits for it, and is replaced by any newer one made meanwhile;
+   * every caller whose request was replaced gets the newer reply.
+   */
+  export async function dfCommGetData(sessionContext: ISessionContext, commData: any, coalesce = false): Promise<any> {
+    const kernel = sessionContext.session?.kernel;
+    if (!kernel) {
+      return undefined;
+    }
+    const channel = getDfCodeChannel(kernel);
+    return new Promise<any>((resolve) => {
+      if (coalesce && channel.inFlight) {
+        if (channel.queued) {
+          channel.queued.data = commData;
+          channel.queued.resolvers.push(resolve);
+        } else {
+          channel.queued = { data: commData, resolvers: [resolve], coalesced: true };
+        }
+        return;
+      }
+      sendDfCodeRequest(channel, { data: commData, resolvers: [resolve], coalesced: coalesce });
     });
   }
 
@@ -238,12 +338,19 @@ import { truncateCellId } from '@dfnotebook/dfutils';
 
     if (!content) return;
 
+    // only cells executed by this request have anything to update
+    const executed = new Set([
+      ...Object.keys(content.persistent_code || {}),
+      ...Object.keys(content.identifier_refs || {})
+    ]);
+    if (executed.size === 0) return;
+
     const cellMap = notebookId ? notebookCellMap.get(notebookId) : undefined;
     const allTags = getAllTags(notebook);
     const cellsArray = Array.from(notebook.cells);
 
     cellsArray.forEach((cell, index) => {
-      if (cell.type === 'code') {
+      if (cell.type === 'code' && executed.has(truncateCellId(cell.id))) {
         updateCellMetadata(cell as ICodeCellModel, content, allTags, cellMap);
       }
     });
@@ -325,6 +432,53 @@ import { truncateCellId } from '@dfnotebook/dfutils';
     return allTags;
   }
 
+  interface ICodeDictState {
+    version: number;
+    sources: Map<string, string>;
+  }
+
+  const notebookCodeDictState = new Map<string, ICodeDictState>();
+
+  /**
+   * Replace the code_dict with only the cells that changed since the last
+   * version sent to the kernel. The first request for a notebook sends
+   * every cell.
+   */
+  export function encodeCodeDict(notebookId: string|undefined, dfMetadata: any): any {
+    if (!notebookId) {
+      return dfMetadata;
+    }
+    const codeDict: { [key: string]: string } = dfMetadata.code_dict;
+    const prev = notebookCodeDictState.get(notebookId);
+    const version = prev ? prev.version + 1 : 1;
+    const sources = new Map<string, string>(Object.entries(codeDict));
+    notebookCodeDictState.set(notebookId, { version, sources });
+    if (!prev) {
+      return { ...dfMetadata, code_dict_mode: 'full', code_dict_version: version };
+    }
+
+    const delta: { [key: string]: string } = {};
+    sources.forEach((source, cId) => {
+      if (prev.sources.get(cId) !== source) {
+        delta[cId] = source;
+      }
+    });
+    return {
+      ...dfMetadata,
+      code_dict: delta,
+      code_dict_mode: 'delta',
+      code_dict_base_version: prev.version,
+      code_dict_version: version,
+      cell_ids: Array.from(sources.keys())
+    };
+  }
+
+  export function resetCodeDict(notebookId: string|undefined) {
+    if (notebookId) {
+      notebookCodeDictState.delete(notebookId);
+    }
+  }
+
   export function getCellsMetadata(notebook: DataflowNotebookModel, cellUUID: string) {
     const codeDict: { [key: string]: string } = {};
     const cellIdModelMap: { [key: string]: any } = {};
@@ -32,6 +32,19 @@ export interface IErrorWithExecCountMsg extends KernelMessage.IErrorMsg {
 
 
 
+/**
+ * All outputs of one cell, sent in a single message when the request
+ * sets `batch_outputs`.
+ */
+export interface IDataflowExecuteResultMsg extends KernelMessage.IIOPubMessage {
+  content: {
+    execution_count: number | null;
+    output_tags: string[];
+    data: { [outputTag: string]: nbformat.IMimeBundle };
+    metadata: { [outputTag: string]: JSONObject };
+  };
+}
+
 export class DataflowOutputArea extends OutputArea {
   constructor(options: OutputArea.IOptions, cellId: string) {
     super({
@@ -46,11 +59,55 @@ export class DataflowOutputArea extends OutputArea {
    */
   static cellIdModelMap: { [key: string]: IOutputAreaModel } | undefined;
 
+  /**
+   * The kernel of the last execution, asked for deferred renderings.
+   */
+  static kernel: Kernel.IKernelConnection | undefined;
+
+  /**
+   * The outputs of each cell before it was last cleared for execution,
+   * restored for outputs the kernel marks unchanged.
+   */
+  static previousOutputs: { [cellId: string]: nbformat.IOutput[] } = {};
+
+  /**
+   * Keep the outputs of a cell that is about to be cleared.
+   */
+  static stashOutputs(cellId: string, outputs: IOutputAreaModel): void {
+    DataflowOutputArea.previousOutputs[cellId] = outputs.toJSON();
+  }
+
+  /**
+   * The digests of the outputs shown for each cell, keyed by output tag
+   * ('' for an untagged output), sent as output_digests.
+   */
+  static outputDigests(cellIdModelMap: {
+    [cellId: string]: IOutputAreaModel;
+  }): JSONObject {
+    const digests: JSONObject = {};
+    for (const cellId in cellIdModelMap) {
+      const outputs = cellIdModelMap[cellId];
+      const cellDigests: JSONObject = {};
+      for (let i = 0; i < outputs.length; i++) {
+        const metadata = outputs.get(i).metadata;
+        if (metadata['output_digest']) {
+          const outputTag = (metadata['output_tag'] as string) || '';
+          cellDigests[outputTag] = metadata['output_digest'];
+        }
+      }
+      if (Object.keys(cellDigests).length) {
+        digests[cellId] = cellDigests;
+      }
+    }
+    return digests;
+  }
+
   /*
    * The cell's id
    */
   cellId: string;
 
+
   get future(): Kernel.IShellFuture<
     KernelMessage.IExecuteRequestMsg,
     KernelMessage.IExecuteReplyMsg
@@ -71,12 +128,34 @@ export class DataflowOutputArea extends OutputArea {
   public onIOPub = (msg: KernelMessage.IIOPubMessage) => {
     const model = this.model;
     const msgType = msg.header.msg_type;
+    if (msg.buffers?.length && (msg.content as any).buffer_paths) {
+      msg = DataflowOutputArea.restoreBuffers(msg);
+    }
+    if (msgType === 'execute_result' && msg.content.metadata?.['unchanged']) {
+      msg = this.restoreUnchanged(msg as KernelMessage.IExecuteResultMsg);
+    }
     let execCountMsg: KernelMessage.IExecuteResultMsg | KernelMessage.IDisplayDataMsg | IStreamWithExecCountMsg | IErrorWithExecCountMsg;
     let output: nbformat.IOutput;
     const transient = ((msg.content as any).transient || {}) as JSONObject;
     const displayId = transient['display_id'] as string;
     let targets: number[];
-    
+
+    if ((msgType as string) === 'dataflow_execute_result') {
+      const content = (msg as IDataflowExecuteResultMsg).content;
+      for (const outputTag of content.output_tags) {
+        this.onIOPub({
+          ...msg,
+          header: { ...msg.header, msg_type: 'execute_result' },
+          content: {
+            execution_count: content.execution_count,
+            data: content.data[outputTag],
+            metadata: content.metadata[outputTag]
+          }
+        } as KernelMessage.IExecuteResultMsg);
+      }
+      return;
+    }
+
     switch (msgType) {
       case 'execute_result':
         execCountMsg = msg as KernelMessage.IExecuteResultMsg;
@@ -121,16 +200,103 @@ export class DataflowOutputArea extends OutputArea {
       };
   };
 
+  /**
+   * Put the binary data the kernel sent as buffers back into the content
+   * at its buffer_paths, base64 encoded as the renderers expect.
+   */
+  static restoreBuffers<T extends KernelMessage.IIOPubMessage>(msg: T): T {
+    const content = JSON.parse(JSON.stringify(msg.content));
+    const bufferPaths = content.buffer_paths as string[][];
+    delete content.buffer_paths;
+    bufferPaths.forEach((path, i) => {
+      let target = content;
+      for (const key of path.slice(0, -1)) {
+        target = target[key];
+      }
+      target[path[path.length - 1]] = Private.toBase64(msg.buffers![i]);
+    });
+    return { ...msg, content, buffers: [] };
+  }
+
+  /**
+   * Fill in an output the kernel marked unchanged from the outputs the
+   * cell had before it was cleared.
+   */
+  protected restoreUnchanged(
+    msg: KernelMessage.IExecuteResultMsg
+  ): KernelMessage.IExecuteResultMsg {
+    const content = msg.content;
+    const cellId =
+      content.execution_count !== null
+        ? cellIdIntToStr(content.execution_count)
+        : this.cellId;
+    const outputTag = content.metadata['output_tag'] ?? null;
+    const previous = (DataflowOutputArea.previousOutputs[cellId] || []).find(
+      output =>
+        output.output_type === 'execute_result' &&
+        ((output.metadata as JSONObject)?.['output_tag'] ?? null) === outputTag
+    ) as nbformat.IExecuteResult | undefined;
+    if (!previous) {
+      return msg;
+    }
+    return {
+      ...msg,
+      content: { ...content, data: previous.data, metadata: previous.metadata }
+    };
+  }
+
   protected createOutputItem(model: IOutputModel): Widget | null {
     const panel = super.createOutputItem(model) as Panel;
     if (panel) {
+      const prompt = panel.widgets[0] as DataflowOutputPrompt;
       if (model.metadata['output_tag']) {
-        const prompt = panel.widgets[0] as DataflowOutputPrompt;
         prompt.outputTag = model.metadata['output_tag'] as string;
       }
+      if (model.metadata['deferred']) {
+        prompt.node.title = 'Preview only, click to render in full';
+        prompt.node.onclick = () => {
+          prompt.node.onclick = null;
+          void this.renderDeferred(model);
+        };
+      }
     }
     return panel;
   }
+
+  /**
+   * Replace an output sent as a preview by its full rendering, fetched
+   * through a dfoutput comm.
+   */
+  protected async renderDeferred(model: IOutputModel): Promise<void> {
+    const kernel = DataflowOutputArea.kernel;
+    if (!kernel || model.executionCount === null) {
+      return;
+    }
+    const comm = kernel.createComm('dfoutput');
+    const reply = new Promise<JSONObject>(resolve => {
+      comm.onMsg = msg => resolve(msg.content.data as JSONObject);
+    });
+    comm.open({
+      uuid: cellIdIntToStr(model.executionCount),
+      output_tag: (model.metadata['output_tag'] as string) ?? null
+    });
+    const content = await reply;
+    if (content.error) {
+      console.error(content.error);
+      return;
+    }
+    for (let i = 0; i < this.model.length; i++) {
+      if (this.model.get(i) === model) {
+        this.model.set(i, {
+          output_type: 'execute_result',
+          execution_count: model.executionCount,
+          data: content.data as nbformat.IMimeBundle,
+          metadata: content.metadata as JSONObject
+        });
+        break;
+      }
+    }
+  }
 }
 
 export class DataflowOutputPrompt extends OutputPrompt {
@@ -202,6 +368,7 @@ export namespace DataflowOutputArea {
     output.future = future;
 
     DataflowOutputArea.cellIdModelMap = cellIdModelMap;
+    DataflowOutputArea.kernel = kernel;
 
     return future.done;
   }
@@ -220,3 +387,23 @@ export namespace DataflowOutputArea {
 
   export const defaultContentFactory = new ContentFactory();
 }
+
+namespace Private {
+  /**
+   * Base64 encode a message buffer.
+   */
+  export function toBase64(buffer: ArrayBuffer | ArrayBufferView): string {
+    const bytes =
+      buffer instanceof ArrayBuffer
+        ? new Uint8Array(buffer)
+        : new Uint8Array(buffer.buffer, buffer.byteOffset, buffer.byteLength);
+    let binary = '';
+    for (let i = 0; i < bytes.length; i += 0x8000) {
+      binary += String.fromCharCode.apply(
+        null,
+        Array.from(bytes.subarray(i, i + 0x8000))
+      );
+    }
+    return btoa(binary);
+  }
+}